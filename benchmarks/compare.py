@@ -0,0 +1,40 @@
+import argparse
+import json
+import sys
+
+
+def load(path):
+
+    with open(path) as f:
+        results = json.load(f)["results"]
+
+    return {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in results}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files and flag the regressions")
+    parser.add_argument("baseline", help="Results of the reference run")
+    parser.add_argument("candidate", help="Results of the run to check")
+    parser.add_argument("--threshold", type=float, default=.1,
+                        help="Relative slowdown of the mean time above which a benchmark is a regression. Default : 0.1")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key]["mean_ms"], candidate[key]["mean_ms"]
+        change = new / old - 1 if old > 0 else 0
+        flag = "REGRESSION" if change > args.threshold else ""
+        regressions += bool(flag)
+        print(f"{key[0]:<28} {key[1]:<70} {old:>10.2f} -> {new:>10.2f} ms {change:>+8.1%} {flag}")
+
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"{key[0]:<28} {key[1]:<70} only in {'baseline' if key in baseline else 'candidate'}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
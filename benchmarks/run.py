@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+import supervision as sv
+
+from benchmarks.stubs import stub_yolo, make_scene, make_video, make_frame_sets
+
+
+def measure(fn, n_iter, warmup=1):
+    """Time fn over n_iter calls, then measure its peak traced memory on one extra call."""
+
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+
+    # Tracing slows down python code, memory is measured separately from the timings
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "iterations": n_iter,
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p90_ms": float(np.percentile(times, 90)),
+        "throughput_per_s": float(1000 / times.mean()),
+        "peak_mem_mb": peak / 1e6,
+    }
+
+
+def record(name, params, stats):
+
+    print(f"{name:<28} {json.dumps(params):<70} {stats['mean_ms']:>10.2f} ms {stats['peak_mem_mb']:>9.1f} MB")
+    return {"name": name, "params": params, **stats}
+
+
+def bench_tiler(quick):
+
+    from modules.detector import Tiler
+
+    sizes = [(1080, 1920), (2000, 8000)] if quick else [(1080, 1920), (2160, 3840), (2000, 8000), (4000, 16000)]
+    settings = [("simple", 0), ("line", 0), ("tile", 640), ("tile", 1280)]
+
+    results = []
+    for height, width in sizes:
+        img = np.zeros((height, width, 3), np.uint8)
+        for tile_mode, tile_size in settings:
+            tiler = Tiler(tile_mode, tile_size, .2)
+            params = {"height": height, "width": width, "tile_mode": tile_mode, "tile_size": tile_size}
+
+            # Layout computed from scratch (first frame of a stream), then tiling with the cached layout
+            stats = measure(lambda: tiler.make_plan(height, width), 20 if quick else 100)
+            stats["n_tiles"] = len(tiler.plan(height, width))
+            results.append(record("tiler.make_plan", params, stats))
+
+            stats = measure(lambda: tiler.tile_image(img), 20 if quick else 100)
+            stats["n_tiles"] = len(tiler.plan(height, width))
+            results.append(record("tiler.tile_image", params, stats))
+
+    return results
+
+
+def make_boxes(rng, n_boxes, min_size, max_size):
+
+    # n_boxes / 2 objects on a 8000x2000 panorama, each one detected twice with a slight shift
+    x1 = rng.uniform(0, 8000, (n_boxes // 2, 1))
+    y1 = rng.uniform(0, 2000, (n_boxes // 2, 1))
+    size = rng.uniform(min_size, max_size, (n_boxes // 2, 1))
+    boxes = np.hstack([x1, y1, x1 + size, y1 + size, rng.uniform(.3, 1, (n_boxes // 2, 1)), rng.integers(0, 2, (n_boxes // 2, 1))])
+    duplicates = boxes + np.hstack([rng.normal(0, 2, (n_boxes // 2, 4)), np.zeros((n_boxes // 2, 2))])
+
+    return np.vstack([boxes, duplicates]).astype(np.float32)
+
+
+def bench_merge(quick):
+
+    from modules.detector import Detector
+
+    rng = np.random.default_rng(0)
+    results = []
+    for merge_mode, n_boxes in [(m, n) for m in ["nms", "wbf"] for n in ([100, 1000] if quick else [100, 1000, 5000, 20000])]:
+
+        with stub_yolo():
+            detector = Detector("stub", iou_thresh=.5, merge_mode=merge_mode)
+
+        # Objects seen by several overlapping tiles give duplicated, slightly shifted boxes
+        tiles = np.array_split(make_boxes(rng, n_boxes, 10, 80), 32)
+
+        stats = measure(lambda: detector.merge_detections(tiles), 5 if quick else 20)
+        results.append(record("detector.merge_detections", {"merge_mode": merge_mode, "n_boxes": n_boxes}, stats))
+
+        # Mixed scales: a fifth of the objects are large (e.g. close to the camera), covering many cells of the small ones
+        tiles = np.array_split(np.vstack([make_boxes(rng, n_boxes * 4 // 5, 10, 40), make_boxes(rng, n_boxes // 5, 300, 1500)]), 32)
+
+        stats = measure(lambda: detector.merge_detections(tiles), 5 if quick else 20)
+        results.append(record("detector.merge_detections", {"merge_mode": merge_mode, "n_boxes": n_boxes, "scales": "mixed"}, stats))
+
+    return results
+
+
+def bench_detector(quick):
+
+    from modules.detector import Detector
+
+    # A small stream served with a larger one by the same model, its tiles sharing the batches
+    small, large = make_scene(720, 1280), make_scene(2160, 3840, seed=1)
+    with stub_yolo(latency_ms=0, per_image_ms=0):
+        detector = Detector("stub")
+
+    results = []
+    for name, frames in [("alone", [small]), ("with_4k", [small, large])]:
+        stats = measure(lambda: detector.detect_batch(frames, .3), 5 if quick else 20)
+
+        # Batching with another stream must not change the detections of a stream
+        alone = detector.detect_batch([small], .3)[0][0]
+        batched = detector.detect_batch(frames, .3)[0][0]
+        stats["same_detections"] = bool(np.array_equal(alone.xyxy, batched.xyxy) and np.array_equal(alone.class_id, batched.class_id))
+        if not stats["same_detections"]:
+            raise AssertionError(f"The detections of a stream batched {name} differ from the ones of the stream alone")
+        results.append(record("detector.detect_batch", {"streams": name}, stats))
+
+    return results
+
+
+def bench_tracker(quick):
+
+    from modules.tracker import Tracker
+
+    rng = np.random.default_rng(0)
+    frame = make_scene(1080, 1920)
+    n_frames = 10 if quick else 50
+
+    results = []
+    for tracker_type in ["ByteTrack", "DeepSort"]:
+        for n_objects in ([10] if quick else [10, 50]):
+
+            # Objects moving linearly across the frame
+            start = rng.uniform(100, 900, (n_objects, 2))
+            velocity = rng.uniform(-5, 5, (n_objects, 2))
+            sequence = []
+            for i in range(n_frames):
+                xy = np.clip(start + i * velocity, 0, [1920 - 60, 1080 - 60])
+                sequence.append(sv.Detections(
+                    xyxy=np.hstack([xy, xy + 60]).astype(np.float32),
+                    confidence=np.full(n_objects, .9, np.float32),
+                    class_id=np.zeros(n_objects, int),
+                ))
+
+            def run():
+                tracker = Tracker(tracker_type, detector=None)
+                for detections in sequence:
+                    tracker.update(detections, [], frame)
+
+            stats = measure(run, 1 if quick else 3)
+            stats["throughput_per_s"] *= n_frames
+            results.append(record("tracker.update", {"tracker": tracker_type, "n_objects": n_objects, "n_frames": n_frames}, stats))
+
+    return results
+
+
+def bench_stitcher(quick, tmp_dir):
+
+    from modules.stitcher import Stitcher
+
+    results = []
+    for view_height, view_width in ([(480, 640)] if quick else [(480, 640), (1080, 1920)]):
+
+        folder = make_frame_sets(os.path.join(tmp_dir, f"views_{view_width}"), 3, view_height, view_width, 3)
+        frames = [sorted(os.path.join(folder, f, v) for v in os.listdir(os.path.join(folder, f))) for f in sorted(os.listdir(folder))]
+        views = [cv.imread(p) for p in frames[0]]
+
+        start = time.perf_counter()
+        stitcher = Stitcher().fit(frames[0], refining_img_paths=frames[0])
+        fit_ms = (time.perf_counter() - start) * 1000
+
+        # Multiband blending, then the fast blending with the same parameters (its weights are built when loading them)
+        for blend in ["multiband", "fast"]:
+            if blend != stitcher.blend:
+                stitcher = Stitcher.from_state(stitcher.get_state(), blend)
+
+            # Views warped one after the other, then concurrently (one thread per view up to the number of cores, skipped with a single core)
+            for view_workers in sorted({1, min(3, os.cpu_count() or 1)}):
+                stitcher.view_workers = view_workers
+                params = {"n_views": 3, "view_height": view_height, "view_width": view_width, "view_workers": view_workers, "blend": blend}
+                stats = measure(lambda: stitcher.stitch(views), 3 if quick else 10)
+                stats["fit_ms"] = fit_ms
+                results.append(record("stitcher.stitch", params, stats))
+
+    return results
+
+
+def bench_scripts(quick, tmp_dir):
+
+    from main import parse_args
+
+    n_frames = 10 if quick else 30
+    video = make_video(os.path.join(tmp_dir, "video.mp4"), 720, 1280, n_frames)
+    frame_sets = make_frame_sets(os.path.join(tmp_dir, "frame_sets"), 3, 480, 640, n_frames // 3)
+    out = os.path.join(tmp_dir, "out")
+
+    # Large panoramas saved as raw arrays, loaded whole or region by region
+    panoramas = os.path.join(tmp_dir, "panoramas")
+    os.makedirs(panoramas, exist_ok=True)
+    for i in range(2):
+        np.save(os.path.join(panoramas, f"{i:05d}.npy"), make_scene(*((2000, 8000) if quick else (4000, 16000)), seed=i))
+
+    runs = [
+        ("detect", ["detect", "--input", video, "--output", out, "--out_format", "mp4"], n_frames),
+        ("detect", ["detect", "--input", video, "--output", out, "--out_format", "mp4", "--tile_mode", "tile", "--tile_size", "640"], n_frames),
+        ("detect", ["detect", "--input", panoramas, "--output", out, "--out_format", "npy", "--tile_mode", "tile", "--tile_size", "1280"], 2),
+        ("detect", ["detect", "--input", panoramas, "--output", out, "--out_format", "npy", "--tile_mode", "tile", "--tile_size", "1280", "--large_image"], 2),
+        ("track", ["track", "--input", video, "--output", out, "--out_format", "mp4"], n_frames),
+        ("stitch", ["stitch", "--frame_folder", frame_sets, "--output", out], len(os.listdir(frame_sets))),
+        ("pipeline", ["pipeline", "--frame_folder", frame_sets, "--output", out, "--out_format", "mp4"], len(os.listdir(frame_sets))),
+    ]
+
+    results = []
+    for name, argv, n in runs:
+
+        args = parse_args(argv)
+
+        def run():
+            with stub_yolo():
+                args.func(args)
+
+        stats = measure(run, 1, warmup=0)
+        stats["throughput_per_s"] *= n
+        results.append(record(f"scripts.{name}", {"argv": " ".join(argv[1:]).replace(tmp_dir, "<tmp>"), "n_frames": n}, stats))
+
+    return results
+
+
+# Run in a fresh interpreter (Linux): time from the first import to the end of the statement, and the peak memory of the process
+STARTUP_CODE = """
+import json, sys, time
+start = time.perf_counter()
+try:
+    {statement}
+except SystemExit:
+    pass
+# VmHWM is reset by exec, unlike the maxrss of getrusage which keeps the peak of the parent process
+peak = int(next(line.split()[1] for line in open("/proc/self/status") if line.startswith("VmHWM")))
+heavy = [m for m in ["torch", "ultralytics", "supervision", "deep_sort_realtime", "stitching"] if m in sys.modules]
+print(json.dumps([time.perf_counter() - start, peak, heavy]), file=sys.__stdout__)
+"""
+
+
+def bench_startup(quick):
+
+    runs = [(f"main.{command} --help", f"import main; sys.stdout = open('/dev/null', 'w'); main.parse_args(['{command}', '--help'])") for command in ["stitch", "detect", "track", "pipeline"]]
+    runs += [(f"import scripts.{command}", f"import scripts.{command}") for command in ["stitch", "detect", "track", "pipeline"]]
+    runs += [(f"import modules.{module}", f"import modules.{module}") for module in ["stitcher", "detector", "tracker"]]
+
+    results = []
+    for name, statement in runs:
+
+        times, peaks = [], []
+        for _ in range(3 if quick else 7):
+            out = subprocess.run([sys.executable, "-c", STARTUP_CODE.format(statement=statement)], capture_output=True, text=True, check=True).stdout
+            duration, peak, heavy = json.loads(out.strip().splitlines()[-1])
+            times.append(duration * 1000)
+            peaks.append(peak / 1e3)
+
+        times = np.array(times)
+        stats = {
+            "iterations": len(times),
+            "mean_ms": float(times.mean()),
+            "p50_ms": float(np.percentile(times, 50)),
+            "p90_ms": float(np.percentile(times, 90)),
+            "throughput_per_s": float(1000 / times.mean()),
+            "peak_mem_mb": float(np.median(peaks)),
+            "heavy_imports": heavy,
+        }
+        results.append(record("startup", {"run": name}, stats))
+
+    return results
+
+
+def get_meta():
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv.__version__,
+    }
+
+
+BENCHMARKS = ["startup", "tiler", "merge", "detector", "tracker", "stitcher", "scripts"]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Offline benchmarks with a stub detection model and synthetic data")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="Path to the .json file where the results are saved")
+    parser.add_argument("--only", nargs="+", default=BENCHMARKS, choices=BENCHMARKS,
+                        help="Benchmarks to run")
+    parser.add_argument("--quick", action="store_true",
+                        help="Smaller sizes and fewer iterations")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        if "startup" in args.only: results += bench_startup(args.quick)
+        if "tiler" in args.only: results += bench_tiler(args.quick)
+        if "merge" in args.only: results += bench_merge(args.quick)
+        if "detector" in args.only: results += bench_detector(args.quick)
+        if "tracker" in args.only: results += bench_tracker(args.quick)
+        if "stitcher" in args.only: results += bench_stitcher(args.quick, tmp_dir)
+        if "scripts" in args.only: results += bench_scripts(args.quick, tmp_dir)
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": get_meta(), "results": results}, f, indent=2)
+
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+import cv2 as cv
+import numpy as np
+import torch
+
+
+class StubBoxes():
+
+    def __init__(self, boxes):
+
+        self.xyxy = torch.from_numpy(boxes[:, :4])
+        self.conf = torch.from_numpy(boxes[:, 4])
+        self.cls = torch.from_numpy(boxes[:, 5])
+
+
+class StubResult():
+
+    def __init__(self, boxes):
+        self.boxes = StubBoxes(boxes)
+
+
+class StubYOLO():
+    """Deterministic stand-in for the ultralytics YOLO wrapper: fixed latency and synthetic boxes."""
+
+    def __init__(self, latency_ms=20, per_image_ms=5, n_boxes=10, n_classes=2):
+
+        self.latency_ms = latency_ms
+        self.per_image_ms = per_image_ms
+        self.n_boxes = n_boxes
+        self.model = SimpleNamespace(names={i: f"class_{i}" for i in range(n_classes)})
+
+
+    def __call__(self, source, conf=.25, verbose=False, **kwargs):
+
+        images = source if isinstance(source, list) else [source]
+        time.sleep((self.latency_ms + self.per_image_ms * len(images)) / 1000)
+
+        return [StubResult(self.boxes(img, conf)) for img in images]
+
+
+    def boxes(self, img, conf):
+
+        # Same image content gives the same boxes
+        h, w = img.shape[:2]
+        rng = np.random.default_rng(int(img[::max(1, h // 8), ::max(1, w // 8)].sum()) + h * w)
+
+        sizes = rng.uniform(.02, .1, (self.n_boxes, 1)) * min(h, w)
+        x1 = rng.uniform(0, 1, (self.n_boxes, 1)) * (w - sizes)
+        y1 = rng.uniform(0, 1, (self.n_boxes, 1)) * (h - sizes)
+        boxes = np.hstack([
+            x1, y1, x1 + sizes, y1 + sizes,
+            rng.uniform(.3, 1, (self.n_boxes, 1)),
+            rng.integers(0, len(self.model.names), (self.n_boxes, 1)),
+        ]).astype(np.float32)
+
+        return boxes[boxes[:, 4] >= conf]
+
+
+@contextmanager
+def stub_yolo(**kwargs):
+    """Make Detector use a StubYOLO instead of loading a model from models/."""
+
+    with mock.patch("modules.backend.YOLO", lambda path: StubYOLO(**kwargs)):
+        yield
+
+
+def make_scene(height, width, seed=0):
+    """Textured synthetic scene with enough keypoints to be stitched."""
+
+    rng = np.random.default_rng(seed)
+    scene = cv.GaussianBlur((rng.random((height, width, 3)) * 255).astype(np.uint8), (0, 0), 6)
+
+    for _ in range(int(height * width / 2500)):
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if rng.random() < .5:
+            cv.circle(scene, (x, y), int(rng.integers(3, 30)), color, -1)
+        else:
+            cv.rectangle(scene, (x, y), (x + int(rng.integers(5, 50)), y + int(rng.integers(5, 50))), color, -1)
+
+    return scene
+
+
+def make_video(path, height, width, n_frames, fps=30, seed=0):
+    """Synthetic video of a scene panning slowly."""
+
+    scene = make_scene(height, width + n_frames * 4, seed)
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for i in range(n_frames):
+        writer.write(np.ascontiguousarray(scene[:, i * 4 : i * 4 + width]))
+    writer.release()
+
+    return path
+
+
+def make_frame_sets(folder, n_views, view_height, view_width, n_frames, overlap=.4, seed=0):
+    """Synthetic multi-view frame sets: overlapping crops of a scene panning slowly, one subfolder per frame."""
+
+    stride = int(view_width * (1 - overlap))
+    scene = make_scene(view_height, stride * (n_views - 1) + view_width + n_frames * 4, seed)
+
+    for i in range(n_frames):
+        frame_folder = os.path.join(folder, f"{i:05d}")
+        os.makedirs(frame_folder, exist_ok=True)
+        for v in range(n_views):
+            x = v * stride + i * 4
+            cv.imwrite(os.path.join(frame_folder, f"view_{v}.jpg"), scene[:, x : x + view_width])
+
+    return folder
@@ -1,10 +1,46 @@
-from scripts.stitch import run_stitching
-from scripts.detect import run_detection
-from scripts.track import run_tracking
 import argparse
+import glob
+import importlib
+import os
 
 
-def parse_args():
+def lazy(module, function):
+
+    # The subcommand (and its heavy dependencies: torch, ultralytics, stitching...) is only imported when it runs
+    def run(args):
+        return getattr(importlib.import_module(module), function)(args)
+
+    return run
+
+
+def adjacency(value):
+
+    # "all", "linear", "circular" or pairs of view indices such as "0-1,1-2,1-3"
+    if value in ["all", "linear", "circular"]:
+        return value
+
+    try:
+        pairs = [tuple(int(idx) for idx in pair.split("-")) for pair in value.split(",")]
+    except ValueError:
+        pairs = []
+    if not pairs or any(len(pair) != 2 or pair[0] == pair[1] for pair in pairs):
+        raise argparse.ArgumentTypeError(f"invalid pairs of views {value!r} (use 'all', 'linear', 'circular' or pairs of view indices such as '0-1,1-2,1-3')")
+
+    return pairs
+
+
+def count_views(args):
+
+    # Views of the rig: the videos, or the images of each frame set (views sorted by name)
+    if getattr(args, "videos", None):
+        from modules.utils import get_inputs
+        return len(get_inputs(args.videos))
+
+    folders = sorted(os.listdir(args.frame_folder)) if os.path.isdir(args.frame_folder) else []
+    return len(glob.glob(f"{args.frame_folder}/{folders[0]}/*.jpg")) if folders else None
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Multi-purpose computer vision toolkit for multi-view settings")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -12,31 +48,54 @@ def parse_args():
     # Stitch subcommand
     # ----------------------------
     parser_stitch = subparsers.add_parser("stitch", help="Stitch a set of frames")
-    parser_stitch.add_argument("--frame_folder", required=True,
+    inputs_stitch = parser_stitch.add_mutually_exclusive_group(required=True)
+    inputs_stitch.add_argument("--frame_folder",
                         help="Path to the frame folder")
+    inputs_stitch.add_argument("--videos", nargs="+",
+                        help="Video of each view (or .txt files listing them, one per line), read in lockstep instead of a frame folder")
+    parser_stitch.add_argument("--offsets", nargs="+", type=float, default=None,
+                        help="With --videos, first frame of each video (or its time in seconds with --sync timestamps) to synchronize them (default: 0 for every video)")
+    parser_stitch.add_argument("--sync", default="frames", choices=["frames", "timestamps"],
+                        help="With --videos, read one frame of each video per step, or match each frame of the first video with the frames of the other ones closest in time")
     parser_stitch.add_argument("--output", required=True,
                         help="Path to the output folder")
-    parser_stitch.add_argument("--out_format", default="jpg", choices=["jpg", "png", "tiff"],
-                        help="Format of the output images")
-    parser_stitch.add_argument("--ref_frame", default=None,
-                        help="Path to the folder containing the reference frame to use to estimate stitching parameters")
+    parser_stitch.add_argument("--out_format", default="jpg", choices=["jpg", "png", "tiff", "npy", "mp4"],
+                        help="Format of the output (images or video)")
+    parser_stitch.add_argument("--out_fps", default=None, type=float,
+                        help="Framerate of the output video (default: the framerate of the first video, 30 with a frame folder)")
+    parser_stitch.add_argument("--ref_frame", default=None, action="append",
+                        help="Path to the folder containing the reference frame to use to estimate stitching parameters, repeat it to keep the one matching best")
+    parser_stitch.add_argument("--ref_candidates", default=1, type=int,
+                        help="Without --ref_frame, number of frames of the input (evenly spaced) on which the stitching parameters are estimated, the one matching best is kept")
+    parser_stitch.add_argument("--adjacency", default="all", type=adjacency,
+                        help="Pairs of views whose features are matched: \"all\", \"linear\" or \"circular\" (views ordered by file name), or a list of pairs such as \"0-1,1-2,1-3\"")
     parser_stitch.add_argument("--detector", default="orb", choices=["orb", "sift", "brisk", "akaze"],
                         help="Keypoints detector to use")
     parser_stitch.add_argument("--warper", default="spherical", choices=["spherical", "cylindrical", "plane", "affine", "fisheye", "stereographic"],
                         help="Warper type")
-    parser_stitch.set_defaults(func=run_stitching)
+    parser_stitch.add_argument("--blend", default="multiband", choices=["multiband", "fast"],
+                        help="Blending of the views: multiband (best quality) or fast (feather weights and exposure gains precomputed once, then a weighted sum per frame)")
+    parser_stitch.add_argument("--calib", default=None,
+                        help="Path to a calibration file: loaded if it exists (skipping the estimation of the stitching parameters), created otherwise")
+    parser_stitch.add_argument("--workers", default=1, type=int,
+                        help="Number of processes stitching frames in parallel")
+    parser_stitch.add_argument("--resume", action="store_true",
+                        help="Go on with an interrupted run on the same output folder, skipping the frames recorded as done in its manifest")
+    parser_stitch.add_argument("--profile", default=None,
+                        help="Path to a .json file where the time spent in each processing stage is saved (per frame and percentiles)")
+    parser_stitch.set_defaults(func=lazy("scripts.stitch", "run_stitching"))
 
     # ----------------------------
     # Detect subcommand (placeholder)
     # ----------------------------
     parser_detect = subparsers.add_parser("detect", help="Run object detection on a set of frames or video")
-    parser_detect.add_argument("--input", required=True,
-                        help="Path to the video or frame folder")
+    parser_detect.add_argument("--input", required=True, action="append",
+                        help="Path to the video or frame folder, repeat it (or give a .txt file listing them) to process several streams with the same model")
     parser_detect.add_argument("--detector", default="yolo11s",
                         help="YOLO model to use")
     parser_detect.add_argument("--output", required=True,
                         help="Path to the output folder")
-    parser_detect.add_argument("--out_format", default="jpg", choices=["jpg", "png", "tiff", "mp4"],
+    parser_detect.add_argument("--out_format", default="jpg", choices=["jpg", "png", "tiff", "npy", "mp4"],
                         help="Output format for detections (images or video)")
     parser_detect.add_argument("--out_fps", default=30, type=int,
                         help="Framerate of the output (only for video)")
@@ -48,19 +107,45 @@ def parse_args():
                         help="Minium overlap ratio between adjacent tiles")
     parser_detect.add_argument("--iou_thresh", default=0.5, type=float,
                         help="IoU threshold to filter detections (only for modes \"line\" and \"tile\")")
+    parser_detect.add_argument("--batch_size", default=8, type=int,
+                        help="Number of tiles sent to the model in a single forward pass")
+    parser_detect.add_argument("--backend", default="torch", choices=["torch", "onnx", "openvino"],
+                        help="Inference backend, the model is exported next to its weights on the first run and the export is reused")
+    parser_detect.add_argument("--precision", default="fp32", choices=["fp32", "fp16", "int8"],
+                        help="Precision of the exported model (int8 with onnx, fp16 with openvino)")
+    parser_detect.add_argument("--merge_mode", default="nms", choices=["nms", "wbf"],
+                        help="How duplicated detections of overlapping tiles are merged: non-maximum suppression or weighted box fusion")
+    parser_detect.add_argument("--motion_gate", action="store_true",
+                        help="Only send the tiles where something moved to the model, the static ones keep their previous detections")
+    parser_detect.add_argument("--max_out_width", default=None, type=int,
+                        help="Maximum width of the output frames, boxes are drawn on the resized frames (default: 1920 for videos, the input width for images)")
+    parser_detect.add_argument("--no_render", action="store_true",
+                        help="Do not draw nor write the output frames, only export the detections (with --save_detections)")
     parser_detect.add_argument("--labels", dest="do_labels", action="store_true",
                         help="Include labels on annotations (default: True)")
     parser_detect.add_argument("--no_labels", dest="do_labels", action="store_false",
                         help="Do not include labels on annotations")
+    parser_detect.add_argument("--segments", default=1, type=int,
+                        help="Split each input into N segments of consecutive frames detected in parallel by N processes, the outputs are then joined in order")
+    parser_detect.add_argument("--large_image", action="store_true",
+                        help="Read the input images (.npy, or .tif/.tiff with tifffile) region by region and write the annotated ones strip by strip (--out_format npy or tiff), the memory used then depends on the tile size and not on the image size")
+    parser_detect.add_argument("--save_detections", default=None,
+                        help="Path to a .npz file where the detections of each frame are saved (can be reused by the track subcommand)")
+    parser_detect.add_argument("--resume", action="store_true",
+                        help="Go on with an interrupted run on the same output folder, skipping the frames recorded as done in its manifest")
+    parser_detect.add_argument("--checkpoint_every", default=0, type=int,
+                        help="Number of frames of each stream between two checkpoints, from which an interrupted run can be resumed (0 for none, the outputs are then written in a single pass)")
+    parser_detect.add_argument("--profile", default=None,
+                        help="Path to a .json file where the time spent in each processing stage is saved (per frame and percentiles)")
     parser_detect.set_defaults(do_labels=True)
-    parser_detect.set_defaults(func=run_detection)
+    parser_detect.set_defaults(func=lazy("scripts.detect", "run_detection"))
 
     # ----------------------------
     # Track subcommand (placeholder)
     # ----------------------------
     parser_track = subparsers.add_parser("track", help="Run object tracking")
-    parser_track.add_argument("--input", required=True,
-                        help="Path to the video or frame folder")
+    parser_track.add_argument("--input", required=True, action="append",
+                        help="Path to the video or frame folder, repeat it (or give a .txt file listing them) to process several streams with the same model")
     parser_track.add_argument("--tracker", default="ByteTrack", choices=["ByteTrack", "DeepSort"],
                         help="Tracker to use")
     parser_track.add_argument("--detector", default="yolo11s",
@@ -79,14 +164,120 @@ def parse_args():
                         help="Minium overlap ratio between adjacent tiles")
     parser_track.add_argument("--iou_thresh", default=0.5, type=float,
                         help="IoU threshold to filter detections (only for modes \"line\" and \"tile\")")
+    parser_track.add_argument("--batch_size", default=8, type=int,
+                        help="Number of tiles sent to the model in a single forward pass")
+    parser_track.add_argument("--backend", default="torch", choices=["torch", "onnx", "openvino"],
+                        help="Inference backend, the model is exported next to its weights on the first run and the export is reused")
+    parser_track.add_argument("--precision", default="fp32", choices=["fp32", "fp16", "int8"],
+                        help="Precision of the exported model (int8 with onnx, fp16 with openvino)")
+    parser_track.add_argument("--merge_mode", default="nms", choices=["nms", "wbf"],
+                        help="How duplicated detections of overlapping tiles are merged: non-maximum suppression or weighted box fusion")
+    parser_track.add_argument("--motion_gate", action="store_true",
+                        help="Only send the tiles where something moved to the model, the static ones keep their previous detections")
+    parser_track.add_argument("--detect_every", default=1, type=int,
+                        help="Run the detection every K frames only, the tracks are moved with the motion model of the tracker in between")
+    parser_track.add_argument("--adaptive_detect", action="store_true",
+                        help="Also run the detection before the next keyframe when tracks are lost or the whole scene changes")
+    parser_track.add_argument("--max_out_width", default=None, type=int,
+                        help="Maximum width of the output frames, boxes are drawn on the resized frames (default: 1920 for videos, the input width for images)")
+    parser_track.add_argument("--no_render", action="store_true",
+                        help="Do not draw nor write the output frames, only export the tracks (with --export_mot)")
     parser_track.add_argument("--labels", dest="do_labels", action="store_true",
                         help="Include labels on annotations (default: True)")
     parser_track.add_argument("--no_labels", dest="do_labels", action="store_false",
                         help="Do not include labels on annotations")
+    parser_track.add_argument("--detections", default=None,
+                        help="Path to detections saved by the detect subcommand (--save_detections) on the same input, the model is then not run")
+    parser_track.add_argument("--export_mot", default=None,
+                        help="Path to a .txt file where the tracks are exported in MOT format")
+    parser_track.add_argument("--resume", action="store_true",
+                        help="Go on with an interrupted run on the same output folder, skipping the frames recorded as done in its manifest")
+    parser_track.add_argument("--checkpoint_every", default=0, type=int,
+                        help="Number of frames of each stream between two checkpoints, from which an interrupted run can be resumed (the tracker state is saved too, 0 for none, the outputs are then written in a single pass)")
+    parser_track.add_argument("--profile", default=None,
+                        help="Path to a .json file where the time spent in each processing stage is saved (per frame and percentiles)")
     parser_track.set_defaults(do_labels=True)
-    parser_track.set_defaults(func=run_tracking)
+    parser_track.set_defaults(func=lazy("scripts.track", "run_tracking"))
+
+    # ----------------------------
+    # Pipeline subcommand
+    # ----------------------------
+    parser_pipeline = subparsers.add_parser("pipeline", help="Stitch a set of frames and run detection/tracking on the panoramas without going through the disk")
+    parser_pipeline.add_argument("--frame_folder", required=True,
+                        help="Path to the frame folder")
+    parser_pipeline.add_argument("--output", required=True,
+                        help="Path to the output folder")
+    parser_pipeline.add_argument("--out_format", default="jpg", choices=["jpg", "png", "tiff", "mp4"],
+                        help="Output format for detections (images or video)")
+    parser_pipeline.add_argument("--out_fps", default=30, type=int,
+                        help="Framerate of the output (only for video)")
+    parser_pipeline.add_argument("--ref_frame", default=None, action="append",
+                        help="Path to the folder containing the reference frame to use to estimate stitching parameters, repeat it to keep the one matching best")
+    parser_pipeline.add_argument("--ref_candidates", default=1, type=int,
+                        help="Without --ref_frame, number of frames of the input (evenly spaced) on which the stitching parameters are estimated, the one matching best is kept")
+    parser_pipeline.add_argument("--adjacency", default="all", type=adjacency,
+                        help="Pairs of views whose features are matched: \"all\", \"linear\" or \"circular\" (views ordered by file name), or a list of pairs such as \"0-1,1-2,1-3\"")
+    parser_pipeline.add_argument("--kp_detector", default="orb", choices=["orb", "sift", "brisk", "akaze"],
+                        help="Keypoints detector to use for stitching")
+    parser_pipeline.add_argument("--warper", default="spherical", choices=["spherical", "cylindrical", "plane", "affine", "fisheye", "stereographic"],
+                        help="Warper type")
+    parser_pipeline.add_argument("--blend", default="multiband", choices=["multiband", "fast"],
+                        help="Blending of the views: multiband (best quality) or fast (feather weights and exposure gains precomputed once, then a weighted sum per frame)")
+    parser_pipeline.add_argument("--calib", default=None,
+                        help="Path to a calibration file: loaded if it exists (skipping the estimation of the stitching parameters), created otherwise")
+    parser_pipeline.add_argument("--save_stitched", default=None,
+                        help="Path to a folder where the stitched frames are also saved (not saved by default)")
+    parser_pipeline.add_argument("--stitch_format", default="jpg", choices=["jpg", "png", "tiff"],
+                        help="Format of the saved stitched frames")
+    parser_pipeline.add_argument("--tracker", default="ByteTrack", choices=["ByteTrack", "DeepSort", "none"],
+                        help="Tracker to use (\"none\" only runs detection)")
+    parser_pipeline.add_argument("--detector", default="yolo11s",
+                        help="YOLO model to use")
+    parser_pipeline.add_argument("--detect_on", default="panorama", choices=["panorama", "views"],
+                        help="Run the detection on the stitched frame or on each original view (boxes are then projected to the panorama)")
+    parser_pipeline.add_argument("--tile_mode", default="simple", choices=["simple", "line", 'tile'],
+                        help="Tiling pattern to use")
+    parser_pipeline.add_argument("--tile_size", default=0, type=int,
+                        help="Tile size to use (only for mode \"tile\")")
+    parser_pipeline.add_argument("--min_ov_ratio", default=0.2, type=float,
+                        help="Minium overlap ratio between adjacent tiles")
+    parser_pipeline.add_argument("--iou_thresh", default=0.5, type=float,
+                        help="IoU threshold to filter detections (only for modes \"line\" and \"tile\")")
+    parser_pipeline.add_argument("--batch_size", default=8, type=int,
+                        help="Number of tiles sent to the model in a single forward pass")
+    parser_pipeline.add_argument("--backend", default="torch", choices=["torch", "onnx", "openvino"],
+                        help="Inference backend, the model is exported next to its weights on the first run and the export is reused")
+    parser_pipeline.add_argument("--precision", default="fp32", choices=["fp32", "fp16", "int8"],
+                        help="Precision of the exported model (int8 with onnx, fp16 with openvino)")
+    parser_pipeline.add_argument("--merge_mode", default="nms", choices=["nms", "wbf"],
+                        help="How duplicated detections of overlapping tiles are merged: non-maximum suppression or weighted box fusion")
+    parser_pipeline.add_argument("--motion_gate", action="store_true",
+                        help="Only send the tiles where something moved to the model, the static ones keep their previous detections (only with --detect_on panorama)")
+    parser_pipeline.add_argument("--detect_every", default=1, type=int,
+                        help="Run the detection every K frames only, the tracks are moved with the motion model of the tracker in between")
+    parser_pipeline.add_argument("--adaptive_detect", action="store_true",
+                        help="Also run the detection before the next keyframe when tracks are lost or the whole scene changes")
+    parser_pipeline.add_argument("--max_out_width", default=None, type=int,
+                        help="Maximum width of the output frames, boxes are drawn on the resized frames (default: 1920 for videos, the input width for images)")
+    parser_pipeline.add_argument("--labels", dest="do_labels", action="store_true",
+                        help="Include labels on annotations (default: True)")
+    parser_pipeline.add_argument("--no_labels", dest="do_labels", action="store_false",
+                        help="Do not include labels on annotations")
+    parser_pipeline.add_argument("--profile", default=None,
+                        help="Path to a .json file where the time spent in each processing stage is saved (per frame and percentiles)")
+    parser_pipeline.set_defaults(do_labels=True)
+    parser_pipeline.set_defaults(func=lazy("scripts.pipeline", "run_pipeline"))
+
+    args = parser.parse_args(argv)
+
+    # The pairs of views must refer to views of the rig
+    if args.command in ["stitch", "pipeline"] and isinstance(args.adjacency, list):
+        n_views = count_views(args)
+        invalid = [f"{i}-{j}" for i, j in args.adjacency if n_views is not None and max(i, j) >= n_views]
+        if invalid:
+            {"stitch": parser_stitch, "pipeline": parser_pipeline}[args.command].error(f"argument --adjacency: {', '.join(invalid)} refer to views missing from the {n_views} views of the input (indices start at 0)")
 
-    return parser.parse_args()
+    return args
 
 
 def main():
@@ -102,4 +293,5 @@ if __name__ == "__main__":
 # python main.py stitch --frame_folder "data/frame_sets/Mairie" --output "data/stitched_sets/Mairie" 
 # python main.py detect --input "data/videos/castagnoles.mp4" --detector fishes --output "data/yolo" --out_format mp4
 # python main.py detect --input data/stitched_sets/Mairie --output data/yolo/Mairie --out_format tiff --tile_mode tile --tile_size 1500
-# python main.py track --input "data/stitched_sets/Parc"  --output "data/tracking" --out_format mp4 --out_fps 3 --tile_mode line
\ No newline at end of file
+# python main.py track --input "data/stitched_sets/Parc"  --output "data/tracking" --out_format mp4 --out_fps 3 --tile_mode line
+# python main.py pipeline --frame_folder "data/frame_sets/Parc" --output "data/tracking" --out_format mp4 --out_fps 3 --tile_mode line --calib "data/calib/Parc.npz"
\ No newline at end of file
@@ -1,24 +1,77 @@
+import dataclasses
+import cv2 as cv
+import numpy as np
 import supervision as sv
+from modules.profiler import profiler
+from modules.large_image import LargeImage, get_strip_height, save_large_image
 
 class Annotator():
 
     def __init__(self, scale_factor, do_labels):
         
+        self.scale_factor = scale_factor
         self.bb_annotator = sv.BoxAnnotator(
-            thickness = int(3 * scale_factor)  # Scale the box thickness
+            thickness = max(1, int(3 * scale_factor))  # Scale the box thickness
         )
 
         self.do_labels = do_labels
         if do_labels:
             self.lbl_annotator = sv.LabelAnnotator(
-                text_thickness = int(2 * scale_factor),
+                text_thickness = max(1, int(2 * scale_factor)),
                 text_scale = 1 * scale_factor,
-                text_padding =  int(4 * scale_factor)
+                text_padding =  max(1, int(4 * scale_factor))
             )
 
-    def __call__(self, image, detections, labels):
-        
-        annotated_frame = self.bb_annotator.annotate(scene=image.copy(), detections=detections)
+    def __call__(self, image, detections, labels, size=None):
+
+        with profiler.stage("annotate"):
+            return self.annotate(image, detections, labels, size)
+
+    def annotate(self, image, detections, labels, size=None):
+
+        # Images read region by region are only drawn on strip by strip, when written
+        if isinstance(image, LargeImage):
+            return StripAnnotation(self, image, detections, labels)
+
+        # Draw on the output frame (width, height): resizing first avoids a copy of the full frame and drawing at full resolution
+        height, width = image.shape[:2]
+        if size and tuple(size) != (width, height):
+            scene = cv.resize(image, size)
+            detections = dataclasses.replace(detections, xyxy=detections.xyxy * np.array([size[0] / width, size[1] / height] * 2, np.float32))
+        else:
+            scene = image.copy()
+
+        annotated_frame = self.bb_annotator.annotate(scene=scene, detections=detections)
         if self.do_labels: annotated_frame = self.lbl_annotator.annotate(scene=annotated_frame, detections=detections, labels=labels)
 
-        return annotated_frame
\ No newline at end of file
+        return annotated_frame
+
+
+class StripAnnotation():
+    """Annotated LargeImage, drawn and written strip by strip so that it is never held whole in memory."""
+
+    def __init__(self, annotator, image, detections, labels):
+
+        self.annotator = annotator
+        self.image = image
+        self.detections = detections
+        self.labels = labels
+        self.shape = image.shape
+        self.strip_height = get_strip_height(image.shape[1])
+
+
+    def strips(self):
+
+        # Boxes are drawn on each strip in its coordinates, the ones crossing strips are drawn in parts
+        # (with more rows around the strip, the thick anti-aliased lines are not clipped at its edges)
+        height, width = self.shape[:2]
+        margin = int(16 * max(1, self.annotator.scale_factor))
+        for y in range(0, height, self.strip_height):
+            top = max(0, y - margin)
+            strip = self.image[top:y + self.strip_height + margin, 0:width]
+            detections = dataclasses.replace(self.detections, xyxy=self.detections.xyxy - np.array([0, top, 0, top], np.float32))
+            yield self.annotator.annotate(strip, detections, self.labels)[y - top:y - top + self.strip_height]
+
+
+    def save(self, path):
+        save_large_image(path, self.shape, self.image.dtype, self.strips(), self.strip_height)
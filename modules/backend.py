@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from ultralytics import YOLO
+
+
+# Precisions available with each backend on CPU
+PRECISIONS = {
+    "torch": ["fp32"],
+    "onnx": ["fp32", "int8"],
+    "openvino": ["fp32", "fp16"],
+}
+
+
+def load_model(model, backend="torch", precision="fp32"):
+    """Load models/{model}.pt, or its export for another backend (exported on the first run, then reused), with the input size to run it at."""
+
+    if precision not in PRECISIONS[backend]:
+        raise ValueError(f"Precision {precision} is not available with the {backend} backend (use one of {PRECISIONS[backend]})")
+
+    weights = f"models/{model}.pt"
+    if backend == "torch":
+        # None: ultralytics uses the input size stored in the weights
+        return YOLO(weights), None
+
+    # Exported at the input size the weights were trained at
+    imgsz = YOLO(weights).overrides.get("imgsz", 640)
+    path = get_export_path(model, backend, precision, imgsz)
+
+    # Export again when the weights are more recent than the export
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(weights):
+        export_model(weights, path, backend, precision, imgsz)
+
+    return YOLO(path, task="detect"), imgsz
+
+
+def get_export_path(model, backend, precision, imgsz):
+
+    # Stored next to the weights, one export per model, input size and precision
+    size = "x".join(map(str, imgsz)) if isinstance(imgsz, (list, tuple)) else imgsz
+    name = f"models/{model}_{size}_{precision}"
+    return f"{name}.onnx" if backend == "onnx" else f"{name}_openvino_model"
+
+
+def export_model(weights, path, backend, precision, imgsz):
+
+    print(f"Exporting {weights} to {path}")
+    folder, name = os.path.split(path)
+    stem = name.removesuffix(".onnx").removesuffix("_openvino_model")
+
+    # Export a copy named after the export path (the exported files keep the name of the weights)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        shutil.copy(weights, f"{tmp_dir}/{stem}.pt")
+
+        # Dynamic axes so that the batches of tiles can have any size
+        exported = YOLO(f"{tmp_dir}/{stem}.pt").export(format=backend, imgsz=imgsz, dynamic=True, half=precision == "fp16")
+
+        if backend == "onnx" and precision == "int8":
+            # Dynamic quantization of the weights, no calibration data needed
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(exported, f"{tmp_dir}/{stem}_int8.onnx", weight_type=QuantType.QUInt8)
+            shutil.move(f"{tmp_dir}/{stem}_int8.onnx", path)
+            return
+
+        for file in os.listdir(tmp_dir):
+            if file != f"{stem}.pt":
+                target = os.path.join(folder, file)
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                shutil.move(os.path.join(tmp_dir, file), target)
@@ -1,19 +1,29 @@
 import cv2 as cv
 import numpy as np
 import supervision as sv
-import torch
-from ultralytics import YOLO
-from ultralytics.utils.ops import non_max_suppression
 
 from modules.annotator import Annotator
+from modules.merger import Merger
+from modules.profiler import profiler
 
 class Detector():
 
-    def __init__(self, model="yolo11s", tile_mode="simple", tile_size=0, min_ov_ratio=.2, iou_thresh=.5, scale_factor=1, do_labels=True):
+    def __init__(self, model="yolo11s", tile_mode="simple", tile_size=0, min_ov_ratio=.2, iou_thresh=.5, scale_factor=1, do_labels=True, batch_size=8, merge_mode="nms", motion_gate=False, backend="torch", precision="fp32"):
         
         self.tiler = Tiler(tile_mode, tile_size, min_ov_ratio)
-        self.model = YOLO(f'models/{model}.pt')
+        # ultralytics (and torch) are only imported when a model is actually loaded
+        from modules.backend import load_model
+        self.model, imgsz = load_model(model, backend, precision)
+        # Exports are run at the input size they were exported at, the torch weights at the one stored in them
+        self.predict_args = {"imgsz": imgsz} if imgsz else {}
         self.iou_thresh = iou_thresh
+        self.merger = Merger(merge_mode, iou_thresh)
+        self.batch_size = max(1, batch_size)
+
+        # Only the tiles where something moved are sent to the model, the others keep their previous detections (state kept per stream)
+        self.motion_gate = motion_gate
+        self.gates, self.previous = {}, {}
+        self.n_tiles, self.n_skipped = 0, 0
         
         self.annotator = Annotator(scale_factor, do_labels)
 
@@ -28,23 +38,90 @@ class Detector():
         return self.annotator(img, detections, labels)
     
 
-    def detect(self, image, conf_thresh):
+    def detect(self, image, conf_thresh, stream=0):
 
         # Image can be path or frame
         img = cv.imread(image) if type(image) == str else image
 
-        tiles = self.tiler.tile_image(img)
+        return self.detect_batch([img], conf_thresh, [stream])[0]
+
+
+    def detect_batch(self, images, conf_thresh, streams=None):
+
+        # Images of different streams (e.g. cameras) share the inference batches
+        streams = list(range(len(images))) if streams is None else streams
+        plans = [self.tiler.plan(*img.shape[:2]) for img in images]
+
+        if self.motion_gate:
+
+            with profiler.stage("gate"):
+                active = [self.gates.setdefault(stream, MotionGate())(img, plan) for img, plan, stream in zip(images, plans, streams)]
+            raw_detections = self.infer(images, conf_thresh, active)
+
+            # Static tiles keep the detections of the last frame they were sent to the model
+            for k, stream in enumerate(streams):
+                previous = self.previous.get(stream, raw_detections[k])
+                raw_detections[k] = [dets if run else prev for dets, run, prev in zip(raw_detections[k], active[k], previous)]
+                self.previous[stream] = raw_detections[k]
+
+                self.n_tiles += len(plans[k])
+                self.n_skipped += int((~active[k]).sum())
+                profiler.count("tiles", len(plans[k]))
+                profiler.count("skipped_tiles", int((~active[k]).sum()))
+
+        else:
+            raw_detections = self.infer(images, conf_thresh)
+
+        results = []
+        for raw, plan in zip(raw_detections, plans):
+            with profiler.stage("merge"):
+                detections = self.merge_detections(raw, plan.rects)
+            results.append((detections, self.get_labels(detections)))
+
+        return results
+    
+
+    def skipped_ratio(self):
+        return self.n_skipped / self.n_tiles if self.n_tiles else 0
+
+
+    def infer(self, images, conf_thresh, active=None):
+
+        # Tiles of all the images share the same batches, active tells which tiles of each image are run (all by default)
+        # Tiles are only cut when their batch is formed, an image read region by region (LargeImage) is never loaded whole
+        plans = [self.tiler.plan(*img.shape[:2]) for img in images]
+        tiles = lambda shape: (
+            (img[rows, cols], (idx, k), x_off, y_off)
+            for idx, (img, plan) in enumerate(zip(images, plans)) if plan.tile_shape == shape
+            for k, ((rows, cols), (x_off, y_off)) in enumerate(zip(plan.slices, plan.offsets.tolist()))
+            if active is None or active[idx][k]
+        )
+        # Only the tiles of the same shape share a batch, a tile is never padded beyond the tiles of its own frame
+        # (a small frame padded to the size of a larger one would be shrunk by the model)
+        shapes = dict.fromkeys(plan.tile_shape for plan in plans)
+        batches = (batch for shape in shapes for batch in self.batch_tiles(tiles(shape), shape))
+
+        # Raw detections of each image, one array per tile (in the order of the tiler, None for the tiles not run)
+        all_detections = [[None] * len(plan) for plan in plans]
+        for batch in profiler.iterate("tile", batches):
+
+            # Run all the tiles of the batch through the model in a single forward pass
+            with profiler.stage("inference"):
+                results = self.model([tile for tile, _, _, _, _ in batch], conf=conf_thresh, verbose=False, **self.predict_args)
+            for (_, (tile_h, tile_w), (idx, k), x_off, y_off), result in zip(batch, results):
+
+                if result.boxes is None:
+                    all_detections[idx][k] = np.empty((0, 6), np.float32)
+                    continue
+
+                boxes = result.boxes.xyxy.cpu().numpy()
+                confs = result.boxes.conf.cpu().numpy()
+                classes = result.boxes.cls.cpu().numpy()
+
+                # Discard the padded area of edge tiles
+                boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, tile_w)
+                boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, tile_h)
 
-        all_detections = []
-        for tile, x_off, y_off in tiles:
-            
-            results = self.model(tile, conf=conf_thresh, verbose=False)[0]
-            if results.boxes is not None:
-                
-                boxes = results.boxes.xyxy.cpu().numpy()
-                confs = results.boxes.conf.cpu().numpy()
-                classes = results.boxes.cls.cpu().numpy()
-                
                 # Map to original coordinates
                 mapped = np.stack([
                     boxes[:, 0] + x_off,
@@ -55,51 +132,122 @@ class Detector():
                     classes
                 ], axis=1)
                 
-                all_detections.append(mapped)
+                all_detections[idx][k] = mapped
 
-        detections = self.merge_detections(all_detections)
+        return all_detections
 
-        labels = [
+
+    def get_labels(self, detections):
+
+        return [
             f"{self.model.model.names[class_id]} {confidence:.2f}"
             for class_id, confidence in zip(detections.class_id, detections.confidence)
         ]
+    
 
+    def batch_tiles(self, tiles, tile_shape):
 
-        return detections, labels
-    
+        # Edge tiles can be smaller than the others, pad them (bottom/right) so every tile of a batch has the same shape
+        tile_h, tile_w = tile_shape
 
-    def merge_detections(self, detections):
+        batch = []
+        for tile, key, x_off, y_off in tiles:
 
-        # dets is a list of arrays from each tile: each of shape (n_i, 6)
-        dets = [d for d in detections if d is not None and len(d) > 0]
+            h, w = tile.shape[:2]
+            if (h, w) != (tile_h, tile_w):
+                tile = cv.copyMakeBorder(tile, 0, tile_h - h, 0, tile_w - w, cv.BORDER_CONSTANT, value=0)
+            batch.append((tile, (h, w), key, x_off, y_off))
 
-        if not dets:
-            return sv.Detections.empty()
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
 
-        all_boxes = np.concatenate(dets, axis=0)
+        if batch:
+            yield batch
 
-        # Convert to torch tensor (batch of 1 image)
-        pred_tensor = torch.tensor(all_boxes, dtype=torch.float32).unsqueeze(0)  # Shape: (1, N, 6)
 
-        # Apply NMS
-        nms_result = non_max_suppression(pred_tensor, iou_thres=self.iou_thresh)
+    def merge_detections(self, detections, tiles=None):
 
-        # Extract the result for this image (since batch=1)
-        merged = nms_result[0].numpy() if len(nms_result[0]) > 0 else []
+        # detections is a list of arrays from each tile: each of shape (n_i, 6), tiles the (x1, y1, x2, y2) of each tile if known
+        dets = [np.empty((0, 6)) if d is None else np.asarray(d).reshape(-1, 6) for d in detections]
+        all_boxes = np.concatenate(dets, axis=0) if dets else np.empty((0, 6))
 
-        if len(merged) == 0:
-            detections = sv.Detections.empty()
-        else:
-            detections = sv.Detections(
-                xyxy=merged[:, 0:4],
-                confidence=merged[:, 4],
-                class_id=merged[:, 5].astype(int),
-            )
+        if len(all_boxes) == 0:
+            return sv.Detections.empty()
+
+        # Tile of each box, used to handle the objects cut by a tile edge
+        tile_ids = np.repeat(np.arange(len(dets)), [len(d) for d in dets])
+        merged = self.merger(all_boxes, tile_ids, tiles)
 
-        return detections
+        return sv.Detections(
+            xyxy=merged[:, 0:4],
+            confidence=merged[:, 4],
+            class_id=merged[:, 5].astype(int),
+        )
     
 
 
+class TilePlan():
+    """Layout of the tiles of a frame size: offsets, rectangles and slices of the tiles."""
+
+    def __init__(self, height, width, offsets, tile_shape):
+
+        self.height = height
+        self.width = width
+        self.tile_shape = tile_shape
+
+        # (x, y) of the top left corner of each tile and its (x1, y1, x2, y2) once clipped to the frame
+        self.offsets = np.array(offsets, dtype=int).reshape(-1, 2)
+        self.rects = np.hstack([self.offsets, np.minimum(self.offsets + tile_shape[::-1], [width, height])])
+        self.slices = [(slice(y1, y2), slice(x1, x2)) for x1, y1, x2, y2 in self.rects]
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class MotionGate():
+    """Find the tiles where the frame changed since they were last sent to the model, on a downscaled grayscale copy."""
+
+    def __init__(self, thresh=20, min_ratio=.001, max_width=480, refresh=100):
+
+        self.thresh = thresh
+        self.min_ratio = min_ratio
+        self.max_width = max_width
+        self.refresh = refresh
+        self.reference = None
+        self.since_refresh = 0
+
+
+    def __call__(self, img, plan):
+
+        h, w = img.shape[:2]
+        scale = min(1, self.max_width / w)
+        small = cv.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv.INTER_AREA)
+        small = cv.GaussianBlur(cv.cvtColor(small, cv.COLOR_BGR2GRAY), (5, 5), 0)
+
+        # Every tile runs on the first frame, after a change of size and regularly to recover from missed changes
+        self.since_refresh += 1
+        if self.reference is None or self.reference.shape != small.shape or self.since_refresh >= self.refresh:
+            self.reference = small
+            self.since_refresh = 0
+            return np.ones(len(plan), bool)
+
+        # Share of changed pixels in each tile, from the integral image of the change mask
+        changed = (cv.absdiff(small, self.reference) > self.thresh).astype(np.uint8)
+        integral = cv.integral(changed)
+        rects = np.round(plan.rects * scale).astype(int).clip(0, [small.shape[1], small.shape[0]] * 2)
+        x1, y1, x2, y2 = rects.T
+        counts = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+        active = counts / np.maximum((x2 - x1) * (y2 - y1), 1) > self.min_ratio
+
+        # The reference of a tile is the frame it was last sent to the model with
+        for x1, y1, x2, y2 in rects[active]:
+            self.reference[y1:y2, x1:x2] = small[y1:y2, x1:x2]
+
+        return active
+
+
 class Tiler():
 
     def __init__(self, tile_mode, tile_size, min_ov_ratio):
@@ -107,12 +255,27 @@ class Tiler():
         self.tile_mode = tile_mode
         self.tile_size = tile_size
         self.min_ov_ratio = min_ov_ratio
+        self.plans = {}
 
 
     def tile_image(self, img):
 
-        tiles = []
-        h, w = img.shape[:2]
+        plan = self.plan(*img.shape[:2])
+
+        return [(img[rows, cols], x, y) for (rows, cols), (x, y) in zip(plan.slices, plan.offsets.tolist())]
+
+
+    def plan(self, h, w):
+
+        # Frames of a stream share the same size, the layout is only computed once
+        key = (h, w, self.tile_mode, self.tile_size, self.min_ov_ratio)
+        if key not in self.plans:
+            self.plans[key] = self.make_plan(h, w)
+
+        return self.plans[key]
+
+
+    def make_plan(self, h, w):
 
         if self.tile_mode == "tile":
 
@@ -120,17 +283,8 @@ class Tiler():
             n_tiles_x, stride_x = self.get_n_tiles(w, self.tile_size)
             n_tiles_y, stride_y = self.get_n_tiles(h, self.tile_size)
 
-            # for y in range(0, h - self.tile_size + 1, stride_y):
-            #     for x in range(0, w - self.tile_size + 1, stride_x):
-            #         tile = img[y:y+self.tile_size, x:x+self.tile_size]
-            #         tiles.append((tile, x, y))
-
-            for i in range(n_tiles_x):
-                for j in range(n_tiles_y):
-                    y = j * stride_y
-                    x = i * stride_x
-                    tile = img[y : y+self.tile_size, x : x+self.tile_size]
-                    tiles.append((tile, x, y))
+            offsets = [(i * stride_x, j * stride_y) for i in range(n_tiles_x) for j in range(n_tiles_y)]
+            tile_shape = (min(self.tile_size, h), min(self.tile_size, w))
 
         elif self.tile_mode == "line":
 
@@ -139,25 +293,19 @@ class Tiler():
 
             # Number of tiles (only in the tiling direction)
             if landscape:
-                
                 n_tiles, stride = self.get_n_tiles(w, h)
-                for i in range(n_tiles):
-                    x = i * stride
-                    tile = img[:, x:x+tile_size]
-                    tiles.append((tile, x, 0))
+                offsets = [(i * stride, 0) for i in range(n_tiles)]
             else:
-                
                 n_tiles, stride = self.get_n_tiles(h, w)
-                for i in range(n_tiles):
-                    y = i * stride
-                    tile = img[y:y+tile_size, :]
-                    tiles.append((tile, 0, y))
+                offsets = [(0, i * stride) for i in range(n_tiles)]
+            tile_shape = (tile_size, tile_size)
 
         else:
 
-            tiles.append((img, 0, 0))
-        
-        return tiles
+            offsets = [(0, 0)]
+            tile_shape = (h, w)
+
+        return TilePlan(h, w, offsets, tile_shape)
 
     
     def get_n_tiles(self, tot_pix, tile_size):
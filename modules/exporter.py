@@ -0,0 +1,135 @@
+import numpy as np
+import supervision as sv
+
+
+class DetectionWriter():
+    """Accumulate the detections of each frame and save them as columnar arrays in a npz file."""
+
+    def __init__(self, path, class_names=None):
+
+        self.path = path
+        self.class_names = class_names or {}
+        self.n_frames = 0
+        self.frames, self.xyxy, self.confidence, self.class_id = [], [], [], []
+
+
+    def add(self, frame_idx, detections):
+
+        self.n_frames = max(self.n_frames, frame_idx + 1)
+        if len(detections) == 0:
+            return
+
+        self.frames.append(np.full(len(detections), frame_idx, dtype=np.int32))
+        self.xyxy.append(detections.xyxy.astype(np.float32))
+        self.confidence.append(detections.confidence.astype(np.float32))
+        self.class_id.append(detections.class_id.astype(np.int16))
+
+
+    def extend(self, other):
+
+        # Detections of another writer (e.g. of another segment of the same input, with the same frame numbering)
+        self.n_frames = max(self.n_frames, other.n_frames)
+        self.frames += other.frames
+        self.xyxy += other.xyxy
+        self.confidence += other.confidence
+        self.class_id += other.class_id
+
+
+    def load(self, path):
+
+        # Detections saved by another writer with the same frame numbering (e.g. a chunk of the same input)
+        data = np.load(path)
+        self.n_frames = max(self.n_frames, int(data["n_frames"]))
+        self.class_names = self.class_names or dict(enumerate(data["class_names"].tolist()))
+        self.frames.append(data["frame"])
+        self.xyxy.append(data["xyxy"])
+        self.confidence.append(data["confidence"])
+        self.class_id.append(data["class_id"])
+
+
+    def close(self):
+
+        # Write through a file handle so numpy does not append the .npz extension
+        with open(self.path, "wb") as f:
+            np.savez_compressed(
+                f,
+                n_frames=self.n_frames,
+                frame=np.concatenate(self.frames) if self.frames else np.empty(0, np.int32),
+                xyxy=np.concatenate(self.xyxy) if self.xyxy else np.empty((0, 4), np.float32),
+                confidence=np.concatenate(self.confidence) if self.confidence else np.empty(0, np.float32),
+                class_id=np.concatenate(self.class_id) if self.class_id else np.empty(0, np.int16),
+                class_names=np.array([self.class_names[k] for k in sorted(self.class_names)]),
+            )
+
+
+class DetectionReader():
+    """Give back the detections of each frame saved by a DetectionWriter."""
+
+    def __init__(self, path):
+
+        data = np.load(path)
+        self.n_frames = int(data["n_frames"])
+        self.class_names = dict(enumerate(data["class_names"].tolist()))
+
+        # Sort the rows by frame once, each frame is then a contiguous slice
+        order = np.argsort(data["frame"], kind="stable")
+        self.xyxy = data["xyxy"][order]
+        self.confidence = data["confidence"][order]
+        self.class_id = data["class_id"][order].astype(int)
+        self.bounds = np.searchsorted(data["frame"][order], np.arange(self.n_frames + 1))
+
+
+    def __len__(self):
+        return self.n_frames
+
+
+    def __getitem__(self, frame_idx):
+
+        if frame_idx >= self.n_frames:
+            return sv.Detections.empty()
+
+        start, end = self.bounds[frame_idx], self.bounds[frame_idx + 1]
+        if start == end:
+            return sv.Detections.empty()
+
+        return sv.Detections(
+            xyxy=self.xyxy[start:end],
+            confidence=self.confidence[start:end],
+            class_id=self.class_id[start:end],
+        )
+
+
+class MOTWriter():
+    """Write tracks in the MOTChallenge text format (frame, id, left, top, width, height, conf, -1, -1, -1)."""
+
+    def __init__(self, path, offset=None):
+
+        # A resumed run goes on after the last checkpointed line
+        if offset is None:
+            self.file = open(path, "w")
+        else:
+            self.file = open(path, "r+")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+
+
+    def flush(self):
+
+        # Size of the file once everything written so far is on disk
+        self.file.flush()
+        return self.file.tell()
+
+
+    def add(self, frame_idx, detections):
+
+        if len(detections) == 0:
+            return
+
+        # MOT frames are numbered from 1
+        for (x1, y1, x2, y2), conf, track_id in zip(detections.xyxy, detections.confidence, detections.tracker_id):
+            conf = -1 if conf is None else conf
+            self.file.write(f"{frame_idx + 1},{track_id},{x1:.2f},{y1:.2f},{x2 - x1:.2f},{y2 - y1:.2f},{conf:.4f},-1,-1,-1\n")
+
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,143 @@
+import os
+import glob
+import importlib
+import numpy as np
+
+
+# Formats read region by region: raw arrays (memory-mapped) and TIFF (with tifffile)
+LARGE_FORMATS = (".npy", ".tif", ".tiff")
+
+
+def import_tifffile():
+
+    # Optional dependency, only needed for TIFF images
+    try:
+        return importlib.import_module("tifffile")
+    except ImportError:
+        raise ImportError("Large TIFF images are read and written with tifffile (pip install tifffile), or use .npy images") from None
+
+
+class LargeImage():
+    """Image on disk (.npy, or .tif/.tiff with tifffile) read region by region, e.g. a gigapixel panorama: only the regions asked for are loaded."""
+
+    def __init__(self, path):
+
+        self.path = path
+        self.is_npy = path.endswith(".npy")
+
+        if self.is_npy:
+            # Raw array: the rows follow the header in the file
+            with open(path, "rb") as f:
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, self.dtype = read_header(f)
+                self.offset = f.tell()
+            if fortran_order:
+                raise ValueError(f"{path} must be saved in C order to be read region by region")
+        else:
+            with import_tifffile().TiffFile(path) as tif:
+                shape, self.dtype = tif.pages[0].shape, tif.pages[0].dtype
+
+        self.shape = tuple(shape)
+
+
+    def __getitem__(self, key):
+
+        # image[rows, cols] like an array, gives back the region as an array
+        rows, cols = key
+        y1, y2, _ = rows.indices(self.shape[0])
+        x1, x2, _ = cols.indices(self.shape[1])
+
+        return self.read(x1, y1, max(x1, x2), max(y1, y2))
+
+
+    def read(self, x1, y1, x2, y2):
+
+        if x2 == x1 or y2 == y1:
+            return np.empty((y2 - y1, x2 - x1, *self.shape[2:]), self.dtype)
+
+        if self.is_npy:
+            # Only the rows of the region are mapped, the pages read are released with the mapping
+            row_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+            rows = np.memmap(self.path, self.dtype, "r", offset=self.offset + y1 * row_bytes, shape=(y2 - y1, *self.shape[1:]))
+            region = np.array(rows[:, x1:x2])
+            del rows
+            return region
+
+        return self.read_tiff(x1, y1, x2, y2)
+
+
+    def read_tiff(self, x1, y1, x2, y2):
+
+        region = np.empty((y2 - y1, x2 - x1, *self.shape[2:]), self.dtype)
+
+        with import_tifffile().TiffFile(self.path) as tif:
+
+            # Only the segments (tiles or strips) of the page overlapping the region are decoded
+            page = tif.pages[0]
+            seg_h, seg_w = (page.tilelength, page.tilewidth) if page.is_tiled else (page.rowsperstrip, page.imagewidth)
+            n_cols = -(-page.imagewidth // seg_w)
+
+            for row in range(y1 // seg_h, (y2 - 1) // seg_h + 1):
+                for col in range(x1 // seg_w, (x2 - 1) // seg_w + 1):
+
+                    idx = row * n_cols + col
+                    tif.filehandle.seek(page.dataoffsets[idx])
+                    segment = page.decode(tif.filehandle.read(page.databytecounts[idx]), idx, jpegtables=page.jpegtables)[0][0]
+                    segment = segment.reshape(segment.shape[:2] + self.shape[2:])
+
+                    # Part of the segment inside the region
+                    seg_y, seg_x = row * seg_h, col * seg_w
+                    top, bottom = max(y1, seg_y), min(y2, seg_y + segment.shape[0])
+                    left, right = max(x1, seg_x), min(x2, seg_x + segment.shape[1])
+                    region[top - y1:bottom - y1, left - x1:right - x1] = segment[top - seg_y:bottom - seg_y, left - seg_x:right - seg_x]
+
+        # TIFF images are RGB, frames are BGR like with OpenCV
+        return region[..., ::-1].copy() if region.ndim == 3 and region.shape[2] == 3 else region
+
+
+def large_image_iterator(path, start=0, end=None):
+    """Yield the images of a folder (or a single image) as LargeImage, like frame_iterator but without reading them."""
+
+    if os.path.isdir(path):
+        image_paths = sorted(p for p in glob.glob(os.path.join(path, "*.*")) if p.lower().endswith(LARGE_FORMATS))[start:end]
+    elif path.lower().endswith(LARGE_FORMATS):
+        image_paths = [path][start:end]
+    else:
+        raise ValueError(f"Invalid input path: {path} (large images must be {', '.join(LARGE_FORMATS)} files)")
+
+    for p in image_paths:
+        yield LargeImage(p)
+
+
+def get_strip_height(width, channels=3, max_bytes=16 << 20):
+
+    # Rows of a strip holding about max_bytes, a multiple of 16 (TIFF tiles)
+    return max(16, max_bytes // (width * channels) // 16 * 16)
+
+
+def save_large_image(path, shape, dtype, strips, strip_height):
+    """Write an image given as consecutive strips of strip_height rows (.npy, or tiled .tif/.tiff with tifffile), one strip in memory at once."""
+
+    if path.endswith(".npy"):
+
+        # Write the header, then append the rows of each strip
+        header = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+        offset = header.offset
+        del header
+
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            for strip in strips:
+                f.write(np.ascontiguousarray(strip, dtype).tobytes())
+        return
+
+    # TIFF tiles of the strip height, RGB
+    tile_w = 256
+    def tiles():
+        for strip in strips:
+            for x in range(0, shape[1], tile_w):
+                tile = strip[:, x:x + tile_w]
+                yield np.ascontiguousarray(tile[..., ::-1] if tile.ndim == 3 and tile.shape[2] == 3 else tile)
+
+    import_tifffile().imwrite(path, tiles(), shape=tuple(shape), dtype=dtype, tile=(strip_height, tile_w), photometric="rgb" if len(shape) == 3 else "minisblack", compression="zlib")
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import threading
+import cv2 as cv
+from modules.utils import AsyncWriter, concat_videos
+
+
+class Manifest():
+    """Completed frames of a run and their outputs, one json line per chunk of frames, so that an interrupted run can be resumed."""
+
+    def __init__(self, path, resume=False):
+
+        self.path = path
+        self.entries = []
+        self.lock = threading.Lock()
+
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Last line cut by the interruption
+                        break
+
+        # Start again from the valid entries only (replaced at once so that the manifest is never lost)
+        with open(f"{path}.tmp", "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in self.entries)
+        os.replace(f"{path}.tmp", path)
+        self.file = open(path, "a")
+
+
+    def add(self, stream, start, end, outputs=(), **info):
+
+        # Frames [start, end) of a stream are done, their outputs are on disk
+        entry = {"stream": stream, "start": start, "end": end, "outputs": list(outputs), **info}
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries.append(entry)
+
+
+    def get_entries(self, stream):
+        return [entry for entry in self.entries if entry["stream"] == stream]
+
+
+    def done(self, stream):
+        return {i for entry in self.get_entries(stream) for i in range(entry["start"], entry["end"])}
+
+
+    def last(self, stream):
+
+        # The chunks of a stream are completed in order, the run goes on after the last one
+        entries = self.get_entries(stream)
+        return entries[-1] if entries else None
+
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkWriter():
+    """Write the output frames of a stream by chunks: one video part per chunk (joined at the end) or image files."""
+
+    def __init__(self, folder, parts_folder, name, out_format, out_fps, size):
+
+        self.folder = folder
+        self.parts_folder = parts_folder
+        self.name = name
+        self.out_format = out_format
+        self.out_fps = out_fps
+        self.size = size
+        self.writer = None
+
+
+    def start(self, start):
+
+        # A video part only becomes readable once released, each chunk has its own
+        if self.out_format == "mp4":
+            self.part = f"{self.parts_folder}/{self.name}_{start:08d}.mp4"
+            self.writer = AsyncWriter(cv.VideoWriter(self.part, cv.VideoWriter_fourcc(*"mp4v"), self.out_fps, self.size))
+        elif self.writer is None:
+            self.writer = AsyncWriter()
+        self.outputs = []
+
+
+    def write(self, frame, i):
+
+        if self.out_format == "mp4":
+            self.writer.write(frame)
+        else:
+            path = f"{self.folder}/{self.name}_{i}.{self.out_format}"
+            self.writer.write(frame, path)
+            self.outputs.append(path)
+
+
+    def commit(self):
+
+        # Wait for all the frames of the chunk to be on disk, gives back the outputs of the chunk
+        if self.out_format == "mp4":
+            self.writer.close()
+            return [self.part]
+
+        self.writer.flush()
+        return self.outputs
+
+
+    def close(self, parts):
+
+        # Join the video parts of all the chunks (including the ones of previous runs)
+        if self.out_format == "mp4":
+            path = f"{self.folder}/{self.name}.mp4"
+            if len(parts) == 1:
+                shutil.move(parts[0], path)
+            elif parts:
+                concat_videos(parts, path, self.out_fps, self.size)
+            return [path]
+
+        self.writer.close()
+        return []
@@ -0,0 +1,204 @@
+import numpy as np
+
+
+class Merger():
+    """Merge the detections of overlapping tiles with NMS or weighted box fusion, each box only being compared with its neighbours."""
+
+    def __init__(self, mode="nms", iou_thresh=.5, border_thresh=.6, border_margin=2):
+
+        self.mode = mode
+        self.iou_thresh = iou_thresh
+        self.border_thresh = border_thresh
+        self.border_margin = border_margin
+
+
+    def __call__(self, boxes, tile_ids=None, tiles=None):
+
+        # boxes is an (n, 6) array (x1, y1, x2, y2, confidence, class), tile_ids the tile each box comes from and tiles the (x1, y1, x2, y2) of each tile
+        boxes = np.asarray(boxes, dtype=np.float64)
+        if len(boxes) == 0:
+            return np.empty((0, 6), np.float32)
+
+        if tiles is not None and tile_ids is not None and len(tiles) > 1:
+            boxes = self.merge_borders(boxes, np.asarray(tile_ids), np.asarray(tiles, dtype=np.float64))
+
+        i, j = self.candidate_pairs(boxes)
+        keep = self.iou(boxes[i], boxes[j]) > self.iou_thresh
+        clusters = self.clusters(boxes[:, 4], i[keep], j[keep])
+
+        if self.mode == "wbf":
+            merged = self.fuse(boxes, clusters)
+        else:
+            merged = boxes[np.unique(clusters)]
+
+        return merged[np.argsort(-merged[:, 4], kind="stable")].astype(np.float32)
+
+
+    def merge_borders(self, boxes, tile_ids, tiles):
+
+        # A box is cut when it touches an edge of its tile lying inside the image (the object continues in the next tile)
+        margin = self.border_margin
+        image = np.concatenate([tiles[:, :2].min(0), tiles[:, 2:].max(0)])
+        own = tiles[tile_ids]
+        inner = np.hstack([own[:, :2] > image[:2], own[:, 2:] < image[2:]])
+        touches = np.hstack([boxes[:, :2] <= own[:, :2] + margin, boxes[:, 2:4] >= own[:, 2:] - margin])
+        cut = (inner & touches).any(1)
+
+        if not cut.any():
+            return boxes
+
+        # Boxes of two tiles are the same object when they match within the area seen by both tiles
+        i, j = self.candidate_pairs(boxes)
+        other = (tile_ids[i] != tile_ids[j]) & (cut[i] | cut[j])
+        i, j = i[other], j[other]
+        shared = np.hstack([np.maximum(tiles[tile_ids[i], :2], tiles[tile_ids[j], :2]), np.minimum(tiles[tile_ids[i], 2:], tiles[tile_ids[j], 2:])])
+        clip_i = np.hstack([np.maximum(boxes[i, :2], shared[:, :2]), np.minimum(boxes[i, 2:4], shared[:, 2:])])
+        clip_j = np.hstack([np.maximum(boxes[j, :2], shared[:, :2]), np.minimum(boxes[j, 2:4], shared[:, 2:])])
+        match = self.iou(clip_i, clip_j) > self.border_thresh
+        i, j = i[match], j[match]
+
+        # A cut box matching a complete one is a duplicate
+        dropped = np.zeros(len(boxes), bool)
+        dropped[i[cut[i] & ~cut[j]]] = True
+        dropped[j[cut[j] & ~cut[i]]] = True
+
+        # Parts of an object cut on both sides of a tile edge are joined
+        both = cut[i] & cut[j] & ~dropped[i] & ~dropped[j]
+        clusters = self.clusters(boxes[:, 4], i[both], j[both])
+        joined = boxes.copy()
+        for axis, ufunc in [(0, np.minimum), (1, np.minimum), (2, np.maximum), (3, np.maximum)]:
+            ufunc.at(joined[:, axis], clusters, boxes[:, axis])
+
+        heads = (clusters == np.arange(len(boxes))) & ~dropped
+        return joined[heads]
+
+
+    def candidate_pairs(self, boxes, ids=None):
+
+        # Spatial hash: each box is registered in every grid cell it covers, only boxes sharing a cell are compared
+        # The cells fit the typical box, the few boxes covering more than 2x2 cells are matched on a coarser grid (recursively)
+        n = len(boxes)
+        ids = np.arange(n) if ids is None else ids
+        sizes = (boxes[ids, 2:4] - boxes[ids, :2]).max(1)
+        cell_size = max(2 * float(np.median(sizes)), 1.)
+        large = (np.floor(boxes[ids, 2:4] / cell_size) - np.floor(boxes[ids, :2] / cell_size) >= 2).any(1)
+
+        small = ids[~large]
+        i, j = self.cell_pairs(boxes, small, small, cell_size)
+        if large.any():
+            # Large boxes with each other, then with the small ones on a grid fitting the large ones
+            # (a small box covers at most 2x2 of its cells, the small boxes are not compared with each other again)
+            large_i, large_j = self.candidate_pairs(boxes, ids[large])
+            cross_i, cross_j = self.cell_pairs(boxes, ids[large], small, max(2 * float(np.median(sizes[large])), 1.))
+            i, j = np.concatenate([i, large_i, np.minimum(cross_i, cross_j)]), np.concatenate([j, large_j, np.maximum(cross_i, cross_j)])
+
+        return i, j
+
+
+    def cell_pairs(self, boxes, ids_a, ids_b, cell_size):
+
+        # Every overlapping pair (a box of ids_a, a box of ids_b) sharing a cell of the grid, one entry per (box, cell) on each side
+        cells = [self.cells(boxes, ids, cell_size) for ids in [ids_a, ids_b]]
+        x_min = min((cx.min() for cx, _, _ in cells if len(cx)), default=0)
+        y_min = min((cy.min() for _, cy, _ in cells if len(cy)), default=0)
+        height = max((cy.max() for _, cy, _ in cells if len(cy)), default=0) - y_min + 1
+        (keys_a, box_a), (keys_b, box_b) = [((cx - x_min) * height + (cy - y_min), box_ids) for cx, cy, box_ids in cells]
+
+        order = np.argsort(keys_b, kind="stable")
+        keys_b, box_b = keys_b[order], box_b[order]
+
+        # Entries of b in the cell of each entry of a
+        lo = np.searchsorted(keys_b, keys_a, "left")
+        counts = np.searchsorted(keys_b, keys_a, "right") - lo
+        a = np.repeat(np.arange(len(keys_a)), counts)
+        b = np.repeat(lo, counts) + np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+        i, j = box_a[a], box_b[b]
+
+        # Boxes of different classes are never merged, the pairs of boxes of the same side are compared once
+        keep = (boxes[i, 5] == boxes[j, 5]) & ((i < j) if ids_a is ids_b else True)
+        i, j, a = i[keep], j[keep], a[keep]
+
+        # Pairs sharing several cells are only kept in the cell of the top left corner of their intersection
+        x1, y1 = np.maximum(boxes[i, 0], boxes[j, 0]), np.maximum(boxes[i, 1], boxes[j, 1])
+        overlap = (np.minimum(boxes[i, 2], boxes[j, 2]) > x1) & (np.minimum(boxes[i, 3], boxes[j, 3]) > y1)
+        corner = (np.floor(x1 / cell_size).astype(np.int64) - x_min) * height + (np.floor(y1 / cell_size).astype(np.int64) - y_min)
+        keep = overlap & (corner == keys_a[a])
+
+        return i[keep], j[keep]
+
+
+    def cells(self, boxes, ids, cell_size):
+
+        # (x, y) of each cell covered by the boxes, with the box of each
+        first = np.floor(boxes[ids, :2] / cell_size).astype(np.int64)
+        span = np.floor(boxes[ids, 2:4] / cell_size).astype(np.int64) - first + 1
+        counts = span[:, 0] * span[:, 1]
+
+        entries = np.repeat(np.arange(len(ids)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = first[entries, 0] + k % span[entries, 0]
+        cy = first[entries, 1] + k // span[entries, 0]
+
+        return cx, cy, ids[entries]
+
+
+    def iou(self, a, b):
+
+        # Intersection over union of each pair of rows of a and b (empty boxes never match)
+        w = (np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])).clip(0)
+        h = (np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])).clip(0)
+        inter = w * h
+        area_a = (a[:, 2] - a[:, 0]).clip(0) * (a[:, 3] - a[:, 1]).clip(0)
+        area_b = (b[:, 2] - b[:, 0]).clip(0) * (b[:, 3] - b[:, 1]).clip(0)
+
+        return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+    def clusters(self, scores, i, j):
+
+        # Greedy NMS on the overlapping pairs: each box joins the cluster of the best scoring box it overlaps that is still a cluster head
+        n = len(scores)
+        clusters = np.full(n, -1)
+        if len(i) == 0:
+            return np.arange(n)
+
+        rank = np.empty(n, np.int64)
+        order = np.argsort(-scores, kind="stable")
+        rank[order] = np.arange(n)
+
+        # Orient every pair from the best scoring box to the other one
+        swap = rank[j] < rank[i]
+        strong, weak = np.where(swap, j, i), np.where(swap, i, j)
+        by_strong = np.argsort(strong, kind="stable")
+        strong, weak = strong[by_strong], weak[by_strong]
+        bounds = np.searchsorted(strong, np.arange(n + 1))
+
+        for head in order[np.isin(order, strong)]:
+            if clusters[head] != -1:
+                continue
+            clusters[head] = head
+            members = weak[bounds[head] : bounds[head + 1]]
+            members = members[clusters[members] == -1]
+            clusters[members] = head
+
+        # Boxes overlapping nothing (or only suppressed boxes) are their own cluster
+        alone = clusters == -1
+        clusters[alone] = np.flatnonzero(alone)
+
+        return clusters
+
+
+    def fuse(self, boxes, clusters):
+
+        # Confidence-weighted average of the coordinates of each cluster, mean of the confidences
+        heads, inverse, counts = np.unique(clusters, return_inverse=True, return_counts=True)
+        weights = boxes[:, 4]
+        total = np.bincount(inverse, weights)
+
+        fused = np.empty((len(heads), 6))
+        for axis in range(4):
+            fused[:, axis] = np.bincount(inverse, weights * boxes[:, axis]) / total
+        fused[:, 4] = total / counts
+        fused[:, 5] = boxes[heads, 5]
+
+        return fused
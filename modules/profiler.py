@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import numpy as np
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler():
+    """Record how long each stage of the processing takes on every frame (disabled by default)."""
+
+    def __init__(self):
+
+        self.enabled = False
+        # Stages captured by a thread apart from the current frame (see capture)
+        self.local = threading.local()
+        self.reset()
+
+
+    def reset(self):
+
+        self.frames = []
+        self.counts = defaultdict(int)
+        self.current = defaultdict(float)
+        self.last_frame = time.perf_counter()
+
+
+    def enable(self):
+
+        self.enabled = True
+        self.reset()
+
+
+    def stage(self, name):
+
+        # Keep the overhead negligible when profiling is off
+        if not self.enabled:
+            return nullcontext()
+
+        return self.timed(name)
+
+
+    @contextmanager
+    def timed(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = getattr(self.local, "captured", None)
+            (self.current if stages is None else stages)[name] += time.perf_counter() - start
+
+
+    @contextmanager
+    def capture(self):
+
+        # Stages timed by this thread in the block are kept apart (e.g. a frame processed in the background while
+        # the main thread times another one), to be added to the frame they belong to with add
+        stages = defaultdict(float)
+        self.local.captured = stages
+        try:
+            yield stages
+        finally:
+            self.local.captured = None
+
+
+    def add(self, stages):
+
+        for name, value in stages.items():
+            self.current[name] += value
+
+
+    def count(self, name, value=1):
+
+        # Counters over the whole run (e.g. number of tiles not sent to the model)
+        if self.enabled:
+            self.counts[name] += value
+
+
+    def iterate(self, name, iterable):
+
+        # Time spent waiting for each item (e.g. frames decoded in the background)
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+    def next_frame(self):
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        self.current["frame"] = now - self.last_frame
+        self.frames.append(dict(self.current))
+
+        self.current = defaultdict(float)
+        self.last_frame = now
+
+
+    def series(self):
+
+        # Per-frame durations of each stage in milliseconds (0 when the stage did not run on a frame)
+        stages = sorted({stage for frame in self.frames for stage in frame})
+        return {stage: [round(frame.get(stage, 0) * 1000, 3) for frame in self.frames] for stage in stages}
+
+
+    def summary(self):
+
+        summary = {}
+        for stage, values in self.series().items():
+            values = np.array(values)
+            summary[stage] = {
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p90": float(np.percentile(values, 90)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(values.max()),
+                "total": float(values.sum()),
+            }
+
+        return summary
+
+
+    def save(self, path):
+
+        with open(path, "w") as f:
+            json.dump({"unit": "ms", "n_frames": len(self.frames), "counts": dict(self.counts), "summary": self.summary(), "frames": self.series()}, f, indent=2)
+
+
+# Shared by all the modules of a run, enabled by the scripts with --profile
+profiler = Profiler()
@@ -1,4 +1,7 @@
+import os
 import cv2 as cv
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from stitching.images import Images
 from stitching.feature_detector import FeatureDetector
 from stitching.feature_matcher import FeatureMatcher
@@ -7,59 +10,66 @@ from stitching.camera_estimator import CameraEstimator
 from stitching.camera_adjuster import CameraAdjuster
 from stitching.camera_wave_corrector import WaveCorrector
 from stitching.warper import Warper
-from stitching.cropper import Cropper
+from stitching.cropper import Cropper, Rectangle
 from stitching.seam_finder import SeamFinder
 from stitching.exposure_error_compensator import ExposureErrorCompensator
 from stitching.blender import Blender
+from stitching.stitching_error import StitchingError
+
+from modules.profiler import profiler
 
 
 class Stitcher():
 
-    def __init__(self, detector="orb", warper_type='spherical'):
+    def __init__(self, detector="orb", warper_type='spherical', adjacency="all", blend="multiband"):
         
         self.detector = detector
+        # Pairs of views whose features are matched: "all", "linear" or "circular" (views in order), or a list of (i, j) pairs
+        self.adjacency = adjacency
         self.cameras = None
         self.warper = Warper(warper_type=warper_type)
         self.cropper = Cropper()
         self.compensator = ExposureErrorCompensator()
         self.seam_masks = None
+        self.remaps = None
+        self.final_masks = None
+        self.final_corners = None
+        self.final_sizes = None
+        self.view_sizes = None
+        self.camera_aspect = None
+        self.lir_aspect = None
+        self.panorama_size = None
+        self.forward_maps = None
+        self.forward_step = 16
+        # Threads warping the views of a frame concurrently (None: one per view, up to the number of cores)
+        self.view_workers = None
+        self.executor = None
+        # "multiband" blending, or "fast": a weighted sum of the views with feather weights and gains precomputed at fit time
+        self.blend = blend
+        self.blend_strength = 5
+        self.blend_weights = None
+        self.blend_buffer = None
         self.ready = False
 
     def fit(self, img_paths, refining_img_paths):
 
-        imgs = Images.of(list(img_paths))
-
-        # Resize images to different resolutions
-        medium_imgs = list(imgs.resize(Images.Resolution.MEDIUM))
-        low_imgs = list(imgs.resize(Images.Resolution.LOW))
-
-        # Detect features on medium images
-        finder = FeatureDetector(detector=self.detector)
-        features = [finder.detect_features(img) for img in medium_imgs]
-
-        # Find matches
-        matcher = FeatureMatcher(matcher_type='homography')
-        matches = matcher.match_features(features)
+        # img_paths (paths or frames) can also be several sets of views (e.g. different frames), the cameras are estimated on the one matching best
+        candidates = [img_paths] if isinstance(img_paths[0], (str, np.ndarray)) else img_paths
 
-        # Detect outliers / images impossible to align
-        subsetter = Subsetter()
-        indices = subsetter.get_indices_to_keep(features, matches)
+        best = None
+        for paths in candidates:
+            estimate = self.estimate_cameras(paths)
+            if estimate is not None and (best is None or estimate[0] > best[0]):
+                best = estimate
 
         # Only estimate stitching parameters if possible to align all images
-        if len(indices) < len(img_paths):
+        if best is None:
             print("Stitcher was unable to estimate the stitching parameters on the given set of images")
-            return
+            return self
 
-        # Estimate camera parameters (intrinsic and extrinsic)) for each image
-        camera_estimator = CameraEstimator()
-        # Refine camera parameters using bundle adjustment 
-        camera_adjuster = CameraAdjuster()
-        # Wave correction
-        wave_corrector = WaveCorrector()
-
-        cameras = camera_estimator.estimate(features, matches)
-        cameras = camera_adjuster.adjust(features, matches, cameras)
-        self.cameras = wave_corrector.correct(cameras)
+        _, imgs, cameras = best
+        self.cameras = cameras
+        low_imgs = list(imgs.resize(Images.Resolution.LOW))
 
         # Setup warper (spherical by default)
         self.warper.set_scale(self.cameras)
@@ -99,6 +109,68 @@ class Stitcher():
         self.ready = True
 
         return self
+
+    def estimate_cameras(self, img_paths):
+
+        imgs = Images.of(list(img_paths))
+
+        # Detect features on medium images, each view in its own thread (with its own detector)
+        medium_imgs = list(imgs.resize(Images.Resolution.MEDIUM))
+        with ThreadPoolExecutor(max_workers=min(len(medium_imgs), os.cpu_count() or 1)) as executor:
+            features = list(executor.map(lambda img: FeatureDetector(detector=self.detector).detect_features(img), medium_imgs))
+
+        # Find matches, only between adjacent views if the layout of the rig is known
+        matcher = FeatureMatcher(matcher_type='homography')
+        matches = matcher.match_features(features, self.get_match_mask(len(features)))
+
+        # Detect outliers / images impossible to align
+        subsetter = Subsetter()
+        try:
+            indices = subsetter.get_indices_to_keep(features, matches)
+        except StitchingError:
+            return None
+
+        if len(indices) < len(img_paths):
+            return None
+
+        # Estimate camera parameters (intrinsic and extrinsic)) for each image
+        camera_estimator = CameraEstimator()
+        # Refine camera parameters using bundle adjustment 
+        camera_adjuster = CameraAdjuster()
+        # Wave correction
+        wave_corrector = WaveCorrector()
+
+        try:
+            cameras = camera_estimator.estimate(features, matches)
+            cameras = camera_adjuster.adjust(features, matches, cameras)
+        except StitchingError:
+            return None
+        cameras = wave_corrector.correct(cameras)
+
+        # Mean confidence of the matched pairs, to compare several sets of views
+        confidences = [match.confidence for match in matches if match.src_img_idx < match.dst_img_idx and match.confidence > 0]
+        score = float(np.mean(confidences)) if confidences else 0.
+
+        return score, imgs, cameras
+
+    def get_match_mask(self, n_views):
+
+        if self.adjacency == "all":
+            return None
+
+        if self.adjacency in ["linear", "circular"]:
+            pairs = [(i, i + 1) for i in range(n_views - 1)]
+            if self.adjacency == "circular" and n_views > 2:
+                pairs.append((n_views - 1, 0))
+        else:
+            pairs = self.adjacency
+
+        # Only the pairs set in the mask are matched
+        mask = np.zeros((n_views, n_views), np.uint8)
+        for i, j in pairs:
+            mask[i, j] = mask[j, i] = 1
+
+        return mask
     
     def refine_parameters(self, ref_images):
 
@@ -118,65 +190,280 @@ class Stitcher():
 
 
         # Get final size and ratio final/medium since warping was estimated on medium images
-        final_sizes = imgs.get_scaled_img_sizes(Images.Resolution.FINAL)
-        camera_aspect = imgs.get_ratio(Images.Resolution.MEDIUM, Images.Resolution.FINAL)
-
-        # Warp final masks
-        warped_final_masks = list(self.warper.create_and_warp_masks(final_sizes, self.cameras, camera_aspect))
-        final_corners, final_sizes = self.warper.warp_rois(final_sizes, self.cameras, camera_aspect)
-
+        self.view_sizes = imgs.get_scaled_img_sizes(Images.Resolution.FINAL)
+        self.camera_aspect = imgs.get_ratio(Images.Resolution.MEDIUM, Images.Resolution.FINAL)
         # Get ratio final/low ratio since cropping ROI was obtained on low resolution images
-        lir_aspect = imgs.get_ratio(Images.Resolution.LOW, Images.Resolution.FINAL)
-        # Crop final images
-        cropped_final_masks = list(self.cropper.crop_images(warped_final_masks, lir_aspect))
-        final_corners, final_sizes = self.cropper.crop_rois(final_corners, final_sizes, lir_aspect)
+        self.lir_aspect = imgs.get_ratio(Images.Resolution.LOW, Images.Resolution.FINAL)
+
+        self.prepare_final_geometry()
 
         # Find seam masks on low images
         seam_finder = SeamFinder()
         self.seam_masks = seam_finder.find(cropped_low_imgs, low_corners, cropped_low_masks)
         # Resize sea masks to finak resolution
-        self.seam_masks = [seam_finder.resize(seam_mask, mask) for seam_mask, mask in zip(self.seam_masks, cropped_final_masks)]
+        self.seam_masks = [seam_finder.resize(seam_mask, mask) for seam_mask, mask in zip(self.seam_masks, self.final_masks)]
 
         # Evaluate the exposure correction to apply to each image
         self.compensator.feed(low_corners, cropped_low_imgs, cropped_low_masks)
-        
 
-    def stitch(self, img_paths):
+        if self.blend == "fast": self.prepare_fast_blend()
 
-        imgs = Images.of(list(img_paths))
-        final_imgs = list(imgs.resize(Images.Resolution.FINAL))
+    def prepare_fast_blend(self):
 
-        # Get final size and ratio final/medium since warping was estimated on medium images
-        final_sizes = imgs.get_scaled_img_sizes(Images.Resolution.FINAL)
-        camera_aspect = imgs.get_ratio(Images.Resolution.MEDIUM, Images.Resolution.FINAL)
+        roi_x, roi_y, width, height = cv.detail.resultRoi(corners=self.final_corners, sizes=self.final_sizes)
+        # Same blend width as the multiband blender
+        blend_width = max(1, int(np.sqrt(width * height) * self.blend_strength / 100))
 
-        # Warp final images
-        warped_final_imgs = list(self.warper.warp_images(final_imgs, self.cameras, camera_aspect))
-        warped_final_masks = list(self.warper.create_and_warp_masks(final_sizes, self.cameras, camera_aspect))
-        final_corners, final_sizes = self.warper.warp_rois(final_sizes, self.cameras, camera_aspect)
+        # Feather weights: the seam masks are smoothed across the seams, only where each view has pixels
+        weights, total = [], np.zeros((height, width), np.float32)
+        for idx, (seam_mask, mask) in enumerate(zip(self.seam_masks, self.final_masks)):
+            seam_mask = cv.UMat.get(seam_mask) if isinstance(seam_mask, cv.UMat) else seam_mask
+            mask = cv.UMat.get(mask) if isinstance(mask, cv.UMat) else mask
+            weight = cv.blur(seam_mask.astype(np.float32) / 255, (blend_width, blend_width)) * (mask > 0)
+            x, y = self.final_corners[idx][0] - roi_x, self.final_corners[idx][1] - roi_y
+            total[y:y + weight.shape[0], x:x + weight.shape[1]] += weight
+            weights.append(weight)
 
-        # Get ratio final/low ratio since cropping ROI was obtained on low resolution images
-        lir_aspect = imgs.get_ratio(Images.Resolution.LOW, Images.Resolution.FINAL)
-        # Crop final images
-        cropped_final_masks = list(self.cropper.crop_images(warped_final_masks, lir_aspect))
-        cropped_final_imgs = list(self.cropper.crop_images(warped_final_imgs, lir_aspect))
-        final_corners, final_sizes = self.cropper.crop_rois(final_corners, final_sizes, lir_aspect)
+        # Normalized weights times the exposure gains, one map per channel so each view is a single multiplication
+        gains = self.compensator.compensator.getMatGains()
+        self.blend_weights = []
+        for idx, weight in enumerate(weights):
+            x, y = self.final_corners[idx][0] - roi_x, self.final_corners[idx][1] - roi_y
+            view_total = total[y:y + weight.shape[0], x:x + weight.shape[1]]
+            weight = np.divide(weight, view_total, out=np.zeros_like(weight), where=view_total > 0)
+            gain = cv.resize(np.asarray(gains[idx], np.float32), weight.shape[::-1], interpolation=cv.INTER_LINEAR)
+            gain = gain if gain.ndim == 3 else gain[..., None]
+            self.blend_weights.append(np.ascontiguousarray(np.broadcast_to(weight[..., None] * gain, (*weight.shape, 3))))
 
-        # Apply exposure compensation
-        compensated_imgs = [self.compensator.apply(idx, corner, img, mask) 
-                        for idx, (img, mask, corner) 
-                        in enumerate(zip(cropped_final_imgs, cropped_final_masks, final_corners))]
-        
-        # Blend images along seam masks (multiband blending)
-        blender = Blender()
-        blender.prepare(final_corners, final_sizes)
-        for img, mask, corner in zip(compensated_imgs, self.seam_masks, final_corners):
-            blender.feed(img, mask, corner)
+        # Panorama accumulated in place frame after frame
+        self.blend_buffer = np.zeros((height, width, 3), np.float32)
+
+    def prepare_final_geometry(self):
+
+        # Warp final masks
+        warped_final_masks = list(self.warper.create_and_warp_masks(self.view_sizes, self.cameras, self.camera_aspect))
+        final_corners, final_sizes = self.warper.warp_rois(self.view_sizes, self.cameras, self.camera_aspect)
+
+        # Crop final masks, the final resolution geometry only depends on the camera parameters
+        self.final_masks = list(self.cropper.crop_images(warped_final_masks, self.lir_aspect))
+        self.final_corners, self.final_sizes = self.cropper.crop_rois(final_corners, final_sizes, self.lir_aspect)
+
+        # Precompute the warping lookup tables of each view, already cropped to the panorama ROI
+        self.remaps = [self.build_remap(idx, size, camera)
+                       for idx, (size, camera) in enumerate(zip(self.view_sizes, self.cameras))]
+
+        # Size of the stitched frames
+        self.panorama_size = tuple(cv.detail.resultRoi(corners=self.final_corners, sizes=self.final_sizes)[2:4])
+
+        # Coarse lookup tables mapping the pixels of each view to panorama coordinates
+        self.forward_maps = [self.build_forward_map(idx, size, camera)
+                             for idx, (size, camera) in enumerate(zip(self.view_sizes, self.cameras))]
+
+    def build_remap(self, idx, size, camera):
+
+        warper = cv.PyRotationWarper(self.warper.warper_type, self.warper.scale * self.camera_aspect)
+        _, xmap, ymap = warper.buildMaps(size, Warper.get_K(camera, self.camera_aspect), camera.R)
+
+        # Cropping the maps rather than the warped image avoids remapping pixels that are cropped out anyway
+        xmap = self.cropper.crop_img(xmap, idx, self.lir_aspect)
+        ymap = self.cropper.crop_img(ymap, idx, self.lir_aspect)
+
+        # Fixed-point maps are faster to remap with
+        return cv.convertMaps(xmap, ymap, cv.CV_16SC2)
+
+    def build_forward_map(self, idx, size, camera):
 
-        stitched, _ = blender.blend()
+        warper = cv.PyRotationWarper(self.warper.warper_type, self.warper.scale * self.camera_aspect)
+        K = Warper.get_K(camera, self.camera_aspect)
+
+        # Offset between the warped coordinates of the view and the panorama coordinates
+        roi_x, roi_y, _, _ = warper.warpRoi(size, K, camera.R)
+        crop = self.cropper.intersection_rectangles[idx].times(self.lir_aspect)
+        off_x = self.final_corners[idx][0] - roi_x - crop.x
+        off_y = self.final_corners[idx][1] - roi_y - crop.y
+
+        # Warp a grid of points covering the whole view, other points are interpolated
+        xs = np.arange(0, size[0] + self.forward_step, self.forward_step)
+        ys = np.arange(0, size[1] + self.forward_step, self.forward_step)
+        points = np.array([[warper.warpPoint((float(x), float(y)), K, camera.R) for x in xs] for y in ys], np.float32)
+
+        return points[..., 0] + off_x, points[..., 1] + off_y
+
+    def project_boxes(self, idx, boxes, n_samples=5):
+
+        # boxes is an array of shape (n, 4+) with xyxy coordinates in view idx, extra columns (conf, class) are kept
+        if len(boxes) == 0:
+            return boxes
+
+        # Warping bends straight lines, sample points along the edges of each box
+        t = np.linspace(0, 1, n_samples)
+        x1, y1, x2, y2 = (boxes[:, i:i+1] for i in range(4))
+        xs = np.hstack([x1 + t * (x2 - x1), np.repeat(x2, n_samples, 1), x1 + t * (x2 - x1), np.repeat(x1, n_samples, 1)])
+        ys = np.hstack([np.repeat(y1, n_samples, 1), y1 + t * (y2 - y1), np.repeat(y2, n_samples, 1), y1 + t * (y2 - y1)])
+
+        # Bilinear interpolation in the coarse lookup tables
+        map_x, map_y = self.forward_maps[idx]
+        grid_x = (xs / self.forward_step).astype(np.float32)
+        grid_y = (ys / self.forward_step).astype(np.float32)
+        pano_x = cv.remap(map_x, grid_x, grid_y, cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+        pano_y = cv.remap(map_y, grid_x, grid_y, cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+
+        # Bounding box of the warped outline, clipped to the cropped panorama
+        width, height = self.panorama_size
+        projected = boxes.copy()
+        projected[:, 0] = pano_x.min(axis=1).clip(0, width)
+        projected[:, 1] = pano_y.min(axis=1).clip(0, height)
+        projected[:, 2] = pano_x.max(axis=1).clip(0, width)
+        projected[:, 3] = pano_y.max(axis=1).clip(0, height)
+
+        # Drop boxes lying in the cropped out area
+        keep = (projected[:, 2] > projected[:, 0]) & (projected[:, 3] > projected[:, 1])
+
+        return projected[keep]
+
+    def stitch(self, images):
+
+        # Views can be paths or frames
+        imgs = [Images.read_image(img) if type(img) == str else img for img in images]
+
+        if any(img is None for img in imgs):
+            raise ValueError("Could not read every view of the frame")
+
+        if [Images.get_image_size(img) for img in imgs] != self.view_sizes:
+            raise ValueError("Frames must have the same size as the ones used to estimate the stitching parameters")
+
+        if self.blend == "fast":
+            return self.fast_blend(imgs)
+
+        # Blend images along seam masks (multiband blending), each view is fed as soon as it is warped
+        # (when profiling, "warp" is the time spent waiting for the next view, warping and compensation included)
+        with profiler.stage("blend"):
+            blender = Blender()
+            blender.prepare(self.final_corners, self.final_sizes)
+
+        for idx, img in profiler.iterate("warp", self.warp_views(imgs)):
+            with profiler.stage("blend"):
+                blender.feed(img, self.seam_masks[idx], self.final_corners[idx])
+
+        with profiler.stage("blend"):
+            stitched, _ = blender.blend()
 
         return stitched
 
+    def fast_blend(self, imgs):
+
+        with profiler.stage("blend"):
+            roi_x, roi_y = cv.detail.resultRoi(corners=self.final_corners, sizes=self.final_sizes)[:2]
+            self.blend_buffer.fill(0)
+
+        # Each warped view is added to the panorama with its weights (exposure compensation included)
+        for idx, img in profiler.iterate("warp", self.warp_views(imgs)):
+            with profiler.stage("blend"):
+                x, y = self.final_corners[idx][0] - roi_x, self.final_corners[idx][1] - roi_y
+                height, width = img.shape[:2]
+                cv.accumulateProduct(img.astype(np.float32), self.blend_weights[idx], self.blend_buffer[y:y + height, x:x + width])
+
+        with profiler.stage("blend"):
+            return cv.convertScaleAbs(self.blend_buffer)
+
+    def warp_views(self, imgs):
+
+        # Views are independent until blending, OpenCV releases the GIL so they are warped concurrently in threads
+        workers = self.view_workers or min(len(imgs), os.cpu_count() or 1)
+        if workers == 1:
+            for idx, img in enumerate(imgs):
+                yield self.warp_view(idx, img)
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        futures = [self.executor.submit(self.warp_view, idx, img) for idx, img in enumerate(imgs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def warp_view(self, idx, img):
+
+        # Warp and crop the final image using the precomputed lookup tables, then apply exposure compensation
+        # (already in the blend weights with the fast blending)
+        map1, map2 = self.remaps[idx]
+        warped = cv.remap(img, map1, map2, cv.INTER_LINEAR, borderMode=cv.BORDER_REFLECT)
+        if self.blend == "fast":
+            return idx, warped
+
+        return idx, self.compensator.apply(idx, self.final_corners[idx], warped, self.final_masks[idx])
+
+    def get_state(self):
+
+        # Plain numpy state, it can be saved to disk or sent to other processes
+        state = {
+            "warper_type": self.warper.warper_type,
+            "warper_scale": self.warper.scale,
+            "focal": [camera.focal for camera in self.cameras],
+            "aspect": [camera.aspect for camera in self.cameras],
+            "ppx": [camera.ppx for camera in self.cameras],
+            "ppy": [camera.ppy for camera in self.cameras],
+            "R": [camera.R for camera in self.cameras],
+            "t": [camera.t for camera in self.cameras],
+            "view_sizes": self.view_sizes,
+            "camera_aspect": self.camera_aspect,
+            "lir_aspect": self.lir_aspect,
+            "overlapping_rectangles": self.cropper.overlapping_rectangles,
+            "intersection_rectangles": self.cropper.intersection_rectangles,
+        }
+        # Seam masks and gains do not have the same shape for every view
+        for idx, seam_mask in enumerate(self.seam_masks):
+            state[f"seam_mask_{idx}"] = cv.UMat.get(seam_mask) if isinstance(seam_mask, cv.UMat) else seam_mask
+        for idx, gains in enumerate(self.compensator.compensator.getMatGains()):
+            state[f"gains_{idx}"] = gains
+
+        return state
+
+    @classmethod
+    def from_state(cls, params, blend="multiband"):
+
+        n_views = len(params["focal"])
+
+        stitcher = cls(warper_type=str(params["warper_type"]), blend=blend)
+        stitcher.warper.scale = float(params["warper_scale"])
+
+        stitcher.cameras = []
+        for idx in range(n_views):
+            camera = cv.detail.CameraParams()
+            camera.focal = float(params["focal"][idx])
+            camera.aspect = float(params["aspect"][idx])
+            camera.ppx = float(params["ppx"][idx])
+            camera.ppy = float(params["ppy"][idx])
+            camera.R = params["R"][idx]
+            camera.t = params["t"][idx]
+            stitcher.cameras.append(camera)
+
+        stitcher.view_sizes = [tuple(int(v) for v in size) for size in params["view_sizes"]]
+        stitcher.camera_aspect = float(params["camera_aspect"])
+        stitcher.lir_aspect = float(params["lir_aspect"])
+        stitcher.cropper.overlapping_rectangles = [Rectangle(*(int(v) for v in r)) for r in params["overlapping_rectangles"]]
+        stitcher.cropper.intersection_rectangles = [Rectangle(*(int(v) for v in r)) for r in params["intersection_rectangles"]]
+
+        stitcher.seam_masks = [params[f"seam_mask_{idx}"] for idx in range(n_views)]
+        stitcher.compensator.compensator.setMatGains([params[f"gains_{idx}"] for idx in range(n_views)])
+
+        # Masks, corners and lookup tables are cheap to rebuild from the cameras
+        stitcher.prepare_final_geometry()
+        if blend == "fast": stitcher.prepare_fast_blend()
+        stitcher.ready = True
+
+        return stitcher
+
+    def save(self, path):
+
+        # Write through a file handle so numpy does not append the .npz extension
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **self.get_state())
+
+    @classmethod
+    def load(cls, path, blend="multiband"):
+        return cls.from_state(np.load(path), blend)
+
     def get_params(self):
         return (self.cameras, self.warper, self.cropper, self.compensator, self.seam_masks)
 
@@ -1,31 +1,150 @@
+import os
+import pickle
+import cv2 as cv
 import supervision as sv
 import numpy as np
-from deep_sort_realtime.deepsort_tracker import DeepSort
+from supervision.tracker.byte_tracker.core import STrack, joint_tracks
 from modules.detector import Detector
 from modules.annotator import Annotator
+from modules.profiler import profiler
 
 
 class Tracker():
 
-    def __init__(self, tracker="ByteTrack", detector="yolo11s", tile_mode="simple", tile_size=0, min_ov_ratio=.2, iou_thresh=.5, scale_factor=1, do_labels=True):
+    def __init__(self, tracker="ByteTrack", detector="yolo11s", tile_mode="simple", tile_size=0, min_ov_ratio=.2, iou_thresh=.5, scale_factor=1, do_labels=True, batch_size=8, merge_mode="nms", detect_every=1, adaptive=False, motion_gate=False, backend="torch", precision="fp32", motion_thresh=10):
         
-        self.detector = Detector(detector, tile_mode, tile_size, min_ov_ratio, iou_thresh)
+        # No model is needed when the detections are given (e.g. loaded from a previous detection run)
+        self.detector = Detector(detector, tile_mode, tile_size, min_ov_ratio, iou_thresh, batch_size=batch_size, merge_mode=merge_mode, motion_gate=motion_gate, backend=backend, precision=precision) if detector else None
         self.annotator = Annotator(scale_factor, do_labels)
 
         if tracker == "ByteTrack":
             self.tracker = sv.ByteTrack(track_activation_threshold=0.25, lost_track_buffer=30, minimum_matching_threshold=0.8) # Default parameters
         else:
+            # Loads torch and the appearance embedder, only imported when DeepSort is used
+            from deep_sort_realtime.deepsort_tracker import DeepSort
             self.tracker = DeepSort(max_age=30, n_init=3, max_iou_distance=.7, max_cosine_distance=.3)
 
+        # Detection only runs on keyframes, the tracks are moved with the motion model of the tracker in between
+        self.detect_every = max(1, detect_every)
+        self.adaptive = adaptive
+        self.motion_thresh = motion_thresh
+        self.since_keyframe = 0
+        self.force_keyframe = True
+        self.keyframe_thumb = None
+        self.last = None
 
-    def __call__(self, frame):
 
-        detections, labels = self.detector.detect(frame, conf_thresh=.3)
-        detections, labels = self.update(detections, labels, frame)
+    def __call__(self, frame, detections=None):
+
+        detections, labels = self.track(frame, detections)
 
         return self.annotator(frame, detections, labels)
 
 
+    def track(self, frame, detections=None, detect=None, keyframe=None):
+
+        # keyframe can be decided beforehand (e.g. to batch the detection of several streams)
+        keyframe = self.is_keyframe(frame) if keyframe is None else keyframe
+        if not keyframe:
+            with profiler.stage("track"):
+                return self.predict()
+
+        # detect gives the detections of the frame another way (e.g. from the original views), only called on keyframes
+        if detections is None:
+            detections, labels = detect() if detect else self.detector.detect(frame, conf_thresh=.3)
+        else:
+            labels = []
+
+        with profiler.stage("track"):
+            n_tracks = len(self.last) if self.last is not None else 0
+            detections, labels = self.update(detections, labels, frame)
+
+        # Tracks lost at a keyframe are searched again on the next frame
+        self.force_keyframe = self.adaptive and len(detections) < n_tracks
+        self.since_keyframe = 0
+        self.last = detections
+
+        return detections, labels
+
+
+    def is_keyframe(self, frame):
+
+        self.since_keyframe += 1
+        if self.detect_every == 1 or self.force_keyframe or self.since_keyframe >= self.detect_every:
+            if self.adaptive: self.keyframe_thumb = self.thumbnail(frame)
+            return True
+
+        # Sudden change of the whole scene (camera motion, lighting), the motion model does not hold anymore
+        if self.adaptive:
+            thumb = self.thumbnail(frame)
+            if cv.absdiff(thumb, self.keyframe_thumb).mean() > self.motion_thresh:
+                self.keyframe_thumb = thumb
+                return True
+
+        return False
+
+
+    def thumbnail(self, frame):
+        return cv.cvtColor(cv.resize(frame, (64, 36), interpolation=cv.INTER_AREA), cv.COLOR_BGR2GRAY)
+
+
+    def predict(self):
+
+        # Class and confidence of each track at the last keyframe
+        last = {} if self.last.tracker_id is None else {
+            track_id: (class_id, conf) for track_id, class_id, conf in zip(self.last.tracker_id, self.last.class_id, self.last.confidence)
+        }
+
+        # Move the tracks one frame forward without any measurement (only their state, they are not counted as missed)
+        if isinstance(self.tracker, sv.ByteTrack):
+
+            STrack.multi_predict(joint_tracks(self.tracker.tracked_tracks, self.tracker.lost_tracks), self.tracker.shared_kalman)
+            self.tracker.frame_id += 1
+            tracks = [(track.tlbr, track.external_track_id) for track in self.tracker.tracked_tracks if track.is_activated]
+
+        else:
+
+            for track in self.tracker.tracker.tracks:
+                track.mean, track.covariance = self.tracker.tracker.kf.predict(track.mean, track.covariance)
+            tracks = [(track.to_tlbr(), int(track.track_id)) for track in self.tracker.tracker.tracks if track.is_confirmed()]
+
+        tracks = [(box, track_id) for box, track_id in tracks if track_id in last]
+        if not tracks:
+            return sv.Detections.empty(), []
+
+        detections = sv.Detections(
+            xyxy=np.array([box for box, _ in tracks], dtype=np.float32),
+            confidence=np.array([last[track_id][1] for _, track_id in tracks]),
+            class_id=np.array([last[track_id][0] for _, track_id in tracks], dtype=int),
+            tracker_id=np.array([track_id for _, track_id in tracks], dtype=int),
+        )
+
+        return detections, [f"#{track_id}" for track_id in detections.tracker_id]
+
+
+    def save_state(self, path):
+
+        # Tracks (with their motion model and id counters) and keyframe schedule, the DeepSort embedder is not part of it
+        tracker = self.tracker if isinstance(self.tracker, sv.ByteTrack) else self.tracker.tracker
+        state = (tracker, self.since_keyframe, self.force_keyframe, self.keyframe_thumb, self.last)
+
+        # Replaced at once, a checkpoint cut by an interruption is never loaded
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+
+    def load_state(self, path):
+
+        with open(path, "rb") as f:
+            tracker, self.since_keyframe, self.force_keyframe, self.keyframe_thumb, self.last = pickle.load(f)
+
+        if isinstance(self.tracker, sv.ByteTrack):
+            self.tracker = tracker
+        else:
+            self.tracker.tracker = tracker
+
+
     def update(self, detections, labels, frame=None):
         
         # Update ByteTrack
@@ -1,15 +1,23 @@
 import cv2 as cv
+import numpy as np
 import os
 import glob
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
 
-def frame_iterator(path):
-    """Yield frames one by one from either a folder or a video."""
+def frame_iterator(path, start=0, end=None):
+    """Yield frames one by one from either a folder or a video (only the frames [start, end) if given)."""
     
     if os.path.isdir(path):
         # --- Folder mode ---
-        image_paths = sorted(glob.glob(os.path.join(path, "*.*")))
+        image_paths = sorted(glob.glob(os.path.join(path, "*.*")))[start:end]
         for p in image_paths:
-            frame = cv.imread(p)
+            frame = read_image(p)
             if frame is not None:
                 yield frame
             else:
@@ -21,17 +29,99 @@ def frame_iterator(path):
         if not cap.isOpened():
             raise ValueError(f"Cannot open video: {path}")
 
-        while True:
+        # Seek to the first frame of the range
+        if start: cap.set(cv.CAP_PROP_POS_FRAMES, start)
+
+        i = start
+        while end is None or i < end:
             ret, frame = cap.read()
             if not ret:
                 break
             yield frame
+            i += 1
 
         cap.release()
     else:
         raise ValueError(f"Invalid input path: {path}")
     
 
+def read_image(path):
+
+    # Raw arrays (.npy) or any image format of OpenCV
+    return np.load(path) if path.endswith(".npy") else cv.imread(path)
+
+
+def write_image(path, frame):
+
+    # Frames too large to be held in memory write themselves (e.g. strip by strip)
+    if not isinstance(frame, np.ndarray):
+        frame.save(path)
+    elif path.endswith(".npy"):
+        np.save(path, frame)
+    else:
+        cv.imwrite(path, frame)
+
+
+def get_inputs(inputs):
+    """Expand the manifest files (.txt, one video or frame folder per line) of a list of inputs."""
+
+    paths = []
+    for path in inputs:
+        if path.endswith(".txt") and os.path.isfile(path):
+            with open(path) as f:
+                paths += [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        else:
+            paths.append(path)
+
+    return paths
+
+
+def get_stream_name(path):
+
+    if os.path.isdir(path):
+        return path.rstrip("/").split("/")[-1]
+    return path.split("/")[-1].split(".")[0]
+
+
+def get_stream_names(paths):
+
+    # Name of each stream in the outputs, numbered when several inputs share the same name
+    names = [get_stream_name(path) for path in paths]
+    return [f"{name}_{k}" if names.count(name) > 1 else name for k, name in enumerate(names)]
+
+
+def stream_path(path, name, multi):
+
+    # With several streams, each one gets its own file (e.g. detections/ex.npz -> detections/ex_cam1.npz)
+    if not path or not multi:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{name}{ext}"
+
+
+def interleave(iterators, starts=None):
+    """Yield the next item of every iterator still running, as a list of (iterator index, item, item index) per step."""
+
+    iterators = [(k, iter(iterator)) for k, iterator in enumerate(iterators)]
+    # Index of the first item of each iterator (e.g. the first frame of a resumed stream)
+    counts = list(starts) if starts else [0] * len(iterators)
+    while iterators:
+
+        step, running = [], []
+        for k, iterator in iterators:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                continue
+            step.append((k, item, counts[k]))
+            running.append((k, iterator))
+            counts[k] += 1
+
+        iterators = running
+        if step:
+            yield step
+
+
 def get_total_frames(path):
 
     if os.path.isdir(path):
@@ -49,4 +139,244 @@ def get_total_frames(path):
         return int(cap.get(cv.CAP_PROP_FRAME_COUNT))
     
     else:
-        raise ValueError(f"Invalid input path: {path}")
\ No newline at end of file
+        raise ValueError(f"Invalid input path: {path}")
+
+
+def get_output_size(width, height, out_format, max_width=None):
+
+    # Videos are at most 1920 px wide by default, images keep the input resolution (never upscaled)
+    max_width = max_width or (1920 if out_format == "mp4" else width)
+    if width <= max_width:
+        return width, height
+
+    return max_width, int(height / width * max_width)
+
+
+def prefetch_frames(path, queue_size=8, workers=2, start=0, end=None):
+    """Yield frames like frame_iterator, decoding them ahead in background threads."""
+
+    if os.path.isdir(path):
+        # --- Folder mode ---
+        # Images are independent, decode several of them at once
+        image_paths = sorted(glob.glob(os.path.join(path, "*.*")))[start:end]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            pending = deque()
+            for p in image_paths:
+                pending.append((p, executor.submit(read_image, p)))
+                if len(pending) >= queue_size:
+                    yield from _ready_frame(*pending.popleft())
+
+            while pending:
+                yield from _ready_frame(*pending.popleft())
+
+    else:
+        # --- Video mode ---
+        # Frames have to be decoded sequentially
+        yield from prefetch_iterator(frame_iterator(path, start, end), queue_size)
+
+
+def get_fps(path, default=30):
+
+    # Framerate of a video (default for folders or when the container does not give it)
+    fps = cv.VideoCapture(path).get(cv.CAP_PROP_FPS) if os.path.isfile(path) else 0
+    return fps or default
+
+
+def timed_frame_iterator(path, start_time=0):
+    """Yield (timestamp in seconds, frame) for each frame of a video, from start_time."""
+
+    cap = cv.VideoCapture(path)
+    if not os.path.isfile(path) or not cap.isOpened():
+        raise ValueError(f"Cannot open video: {path}")
+
+    if start_time > 0: cap.set(cv.CAP_PROP_POS_MSEC, start_time * 1000)
+
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        # Position of the frame just read
+        yield cap.get(cv.CAP_PROP_POS_MSEC) / 1000, frame
+
+    cap.release()
+
+
+def synced_frames(paths, offsets=None, sync="frames", start=0):
+    """Yield the frames of several inputs read in lockstep, as a list of frames (one per input) per step.
+
+    With sync="frames", offsets are the index of the first frame of each input, with sync="timestamps" its time in seconds
+    (each step is then a frame of the first input with the frames of the other inputs closest in time)."""
+
+    offsets = offsets or [0] * len(paths)
+
+    # Each input is decoded in its own background thread
+    if sync == "frames":
+        iterators = [prefetch_iterator(frame_iterator(path, int(offset) + start)) for path, offset in zip(paths, offsets)]
+    else:
+        fps = get_fps(paths[0])
+        start_time = offsets[0] + start / fps
+        # The other inputs start a bit earlier so the frame closest in time is not skipped
+        iterators = [prefetch_iterator(timed_frame_iterator(paths[0], start_time))]
+        iterators += [prefetch_iterator(timed_frame_iterator(path, max(0, start_time - offsets[0] + offset - 1))) for path, offset in zip(paths[1:], offsets[1:])]
+
+    try:
+        if sync == "frames":
+            yield from (list(frames) for frames in zip(*iterators))
+        else:
+            yield from _synced_timestamps(iterators, offsets, fps)
+
+    finally:
+        # Stop the decoders still running when the shortest input ends or the consumer stops early
+        for iterator in iterators:
+            iterator.close()
+
+
+def get_synced_length(paths, offsets=None, sync="frames"):
+
+    # Number of steps of synced_frames (approximate with timestamps)
+    offsets = offsets or [0] * len(paths)
+    if sync == "frames":
+        return max(0, min(get_total_frames(path) - int(offset) for path, offset in zip(paths, offsets)))
+
+    duration = min(get_total_frames(path) / get_fps(path) - offset for path, offset in zip(paths, offsets))
+    return max(0, int(duration * get_fps(paths[0])))
+
+
+def _synced_timestamps(iterators, offsets, fps):
+
+    # Current and next (time, frame) of the other inputs, times relative to the offset of each input
+    current = [None] * len(iterators)
+    upcoming = [None] + [next(iterator, None) for iterator in iterators[1:]]
+
+    for time, frame in iterators[0]:
+        time -= offsets[0]
+
+        frames = [frame]
+        for k in range(1, len(iterators)):
+            # Move forward while the next frame is closer in time
+            while upcoming[k] is not None and (current[k] is None or abs(upcoming[k][0] - offsets[k] - time) <= abs(current[k][0] - offsets[k] - time)):
+                current[k], upcoming[k] = upcoming[k], next(iterators[k], None)
+
+            # The sequence ends with the shortest input
+            if current[k] is None or (upcoming[k] is None and time - (current[k][0] - offsets[k]) > .5 / fps):
+                return
+            frames.append(current[k][1])
+
+        yield frames
+
+
+def concat_videos(paths, out_path, fps, size):
+    """Join videos of the same size into a single one, without re-encoding when ffmpeg is available."""
+
+    if shutil.which("ffmpeg"):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.writelines(f"file '{os.path.abspath(p)}'\n" for p in paths)
+        try:
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", f.name, "-c", "copy", out_path], check=True)
+        finally:
+            os.remove(f.name)
+        return
+
+    # Re-encode the frames of each video otherwise
+    video = cv.VideoWriter(out_path, cv.VideoWriter_fourcc(*"mp4v"), fps, size)
+    for p in paths:
+        for frame in frame_iterator(p):
+            video.write(frame)
+    video.release()
+
+
+def _ready_frame(p, future):
+
+    frame = future.result()
+    if frame is not None:
+        yield frame
+    else:
+        print(f"Warning: could not read {p}")
+
+
+class _Done():
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def prefetch_iterator(iterator, queue_size=8):
+    """Consume an iterator in a background thread, keeping up to queue_size items ready."""
+
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterator:
+                queue.put(item)
+                if stop.is_set():
+                    return
+            queue.put(_Done())
+        except Exception as e:
+            queue.put(_Done(e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if isinstance(item, _Done):
+                if item.error is not None:
+                    raise item.error
+                break
+            yield item
+
+    finally:
+        # Unblock the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=.1)
+            except Empty:
+                pass
+
+
+class AsyncWriter():
+    """Encode and write frames in background threads, either to a video or to image files."""
+
+    def __init__(self, video=None, workers=2, queue_size=8):
+
+        self.video = video
+        # A single thread keeps the frames of a video in order
+        self.executor = ThreadPoolExecutor(max_workers=1 if video is not None else workers)
+        self.queue_size = queue_size
+        self.pending = deque()
+
+
+    def write(self, frame, path=None, callback=None):
+
+        # Wait for the oldest frame to be written to keep memory bounded
+        if len(self.pending) >= self.queue_size:
+            self.pending.popleft().result()
+
+        if self.video is not None:
+            future = self.executor.submit(self.video.write, frame)
+        else:
+            future = self.executor.submit(write_image, path, frame)
+
+        # callback is called once the frame is written (e.g. to record it as done)
+        if callback: future.add_done_callback(lambda f: callback() if f.exception() is None else None)
+        self.pending.append(future)
+
+
+    def flush(self):
+
+        while self.pending:
+            self.pending.popleft().result()
+
+
+    def close(self):
+
+        self.flush()
+        self.executor.shutdown()
+
+        if self.video is not None:
+            self.video.release()
@@ -1,12 +1,57 @@
 import os
+import shutil
 import cv2 as cv
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from modules.utils import frame_iterator, get_total_frames
+from modules.profiler import profiler
+from modules.utils import frame_iterator, prefetch_frames, get_total_frames, get_inputs, get_stream_names, stream_path, interleave, get_output_size, concat_videos, AsyncWriter
+from modules.annotator import Annotator
 from modules.detector import Detector
+from modules.exporter import DetectionWriter
+from modules.manifest import Manifest, ChunkWriter
+from modules.large_image import large_image_iterator
+
+
+# Detector of the current worker process, loaded once per process
+_worker_detector = None
+
+def init_worker(detector_kwargs, n_threads):
+
+    global _worker_detector
+    # Parallelism comes from the processes, each one only uses its share of the cores
+    import torch
+    cv.setNumThreads(1)
+    torch.set_num_threads(n_threads)
+    _worker_detector = Detector(**detector_kwargs)
+
+
+def detect_segment(job):
+
+    # Detect the frames [start, end) of an input, keeping the frame numbers of the whole input
+    model = _worker_detector
+    annotator = Annotator(job["scale_factor"], job["do_labels"])
+    video = cv.VideoWriter(job["video"], cv.VideoWriter_fourcc(*"mp4v"), job["fps"], job["size"]) if job["video"] else None
+    writer = AsyncWriter(video) if job["render"] else None
+    detection_writer = DetectionWriter(None, model.model.model.names) if job["save"] else None
+
+    for i, frame in enumerate(prefetch_frames(job["input"], start=job["start"], end=job["end"]), job["start"]):
+
+        # Each segment has its own motion gate state
+        detections, labels = model.detect(frame, .3, stream=job["key"])
+        if detection_writer: detection_writer.add(i, detections)
+
+        if writer:
+            annotated_frame = annotator(frame, detections, labels, job["size"])
+            writer.write(annotated_frame, None if video else job["image"].format(i))
+
+    if writer: writer.close()
+
+    return detection_writer
+
 
 def run_detection(args):
 
-    input = args.input
+    inputs = get_inputs(args.input)
     output = args.output
     out_format = args.out_format
     out_fps = args.out_fps
@@ -16,33 +61,221 @@ def run_detection(args):
     min_ov_ratio = args.min_ov_ratio
     iou_thresh = args.iou_thresh
     do_labels = args.do_labels
+    max_out_width = args.max_out_width
+    render = not args.no_render
+    batch_size = args.batch_size
+    merge_mode = args.merge_mode
+    motion_gate = args.motion_gate
+    backend = args.backend
+    precision = args.precision
+    profile = args.profile
+    save_detections = args.save_detections
+    segments = args.segments
+    resume = args.resume
+    checkpoint_every = args.checkpoint_every
+    large_image = args.large_image
+
+    if not render and not save_detections:
+        print("Nothing to save: use --save_detections with --no_render")
+        return
+
+    # Large images are read region by region and written strip by strip, never whole
+    if large_image:
+        if render and (out_format not in ["npy", "tiff"] or max_out_width):
+            print("Large images are annotated at full resolution: use --out_format npy or tiff without --max_out_width, or --no_render")
+            return
+        if motion_gate:
+            print("Warning: the motion gate needs whole frames, it is not used with --large_image")
+            motion_gate = False
+        if segments > 1:
+            print("Warning: --segments is not supported with --large_image, the frames are detected sequentially")
+            segments = 1
+
+    if segments > 1:
+        if profile: print("Warning: the detection stages are not profiled with several segments")
+        if resume: print("Warning: --resume is not supported with several segments, all the frames are detected")
+        detector_kwargs = dict(model=model, tile_mode=tile_mode, tile_size=tile_size, min_ov_ratio=min_ov_ratio, iou_thresh=iou_thresh, batch_size=batch_size, merge_mode=merge_mode, motion_gate=motion_gate, backend=backend, precision=precision)
+        detect_segments(inputs, output, out_format, out_fps, max_out_width, do_labels, render, save_detections, detector_kwargs, segments)
+        return
+
+    # A single model serves all the streams
+    model = Detector(model, tile_mode, tile_size, min_ov_ratio, iou_thresh, batch_size=batch_size, merge_mode=merge_mode, motion_gate=motion_gate, backend=backend, precision=precision)
+    class_names = model.model.model.names
+
+    os.makedirs(output, exist_ok=True)
+
+    # The outputs are committed every checkpoint_every frames, a resumed run goes on after the last committed chunk of each stream
+    manifest = Manifest(f"{output}/manifest.jsonl", resume)
+    parts_folder = f"{output}/parts"
+    if not resume: shutil.rmtree(parts_folder, ignore_errors=True)
+    os.makedirs(parts_folder, exist_ok=True)
+
+    names = get_stream_names(inputs)
+    streams = []
+    for input, filename in zip(inputs, names):
+
+        last = manifest.last(filename)
+        if last and last.get("complete"):
+            print(f"{filename} : already done")
+            continue
+
+        first_frame = next(large_image_iterator(input) if large_image else frame_iterator(input))
+        height, width = first_frame.shape[:2]
+
+        # Boxes are drawn on the resized output frame, scaled to its size
+        frame_width, frame_height = get_output_size(width, height, out_format, max_out_width)
+        scale_factor = min(frame_width, frame_height) / 1000
+
+        stream = {
+            "input": input,
+            "filename": filename,
+            "start": last["end"] if last else 0,
+            "end": last["end"] if last else 0,
+            "size": (frame_width, frame_height),
+            "annotator": Annotator(scale_factor, do_labels),
+            "frames": ChunkWriter(output, parts_folder, f"YOLO_{filename}", out_format, out_fps, (frame_width, frame_height)) if render else None,
+            "detections_path": stream_path(save_detections, filename, len(inputs) > 1) if save_detections else None,
+        }
+        start_chunk(stream, parts_folder, class_names)
+        streams.append(stream)
+
+    if profile: profiler.enable()
 
-    if os.path.isdir(input):
-        filename = input.split("/")[-1]
-    else:
-        filename = input.split("/")[-1].split(".")[0]
+    # One frame of each stream per step, from the first frame not done yet
+    starts = [stream["start"] for stream in streams]
+    read_frames = large_image_iterator if large_image else prefetch_frames
+    frames = interleave([read_frames(stream["input"], start=start) for stream, start in zip(streams, starts)], starts)
+    tot_frames = sum(get_total_frames(stream["input"]) - start for stream, start in zip(streams, starts))
+    with tqdm(total=tot_frames, desc="Processing frames", unit="frame", colour="green") as progress:
+        for step in profiler.iterate("read", frames):
 
-    first_frame = next(frame_iterator(input))
-    height, width = first_frame.shape[:2]
-    scale_factor = min(width, height) / 1000
+            # The tiles of the frames of all the streams share the inference batches
+            results = model.detect_batch([frame for _, frame, _ in step], conf_thresh=.3, streams=[k for k, _, _ in step])
 
-    model = Detector(model, tile_mode, tile_size, min_ov_ratio, iou_thresh, scale_factor, do_labels)
+            for (k, frame, i), (detections, labels) in zip(step, results):
+
+                stream = streams[k]
+                if save_detections: stream["detection_writer"].add(i, detections)
+
+                # Only the detections are exported without rendering
+                if render:
+                    annotated_frame = stream["annotator"](frame, detections, labels, stream["size"])
+
+                    with profiler.stage("write"):
+                        stream["frames"].write(annotated_frame, i)
+
+                stream["end"] = i + 1
+                if checkpoint_every and stream["end"] - stream["start"] >= checkpoint_every:
+                    with profiler.stage("write"):
+                        commit_chunk(manifest, stream)
+                        start_chunk(stream, parts_folder, class_names)
+
+                progress.update()
+
+            profiler.next_frame()
+
+    for stream in streams:
+        finish_stream(manifest, stream)
+    manifest.close()
+    shutil.rmtree(parts_folder, ignore_errors=True)
+
+    if motion_gate: print(f"Tiles skipped by the motion gate : {model.skipped_ratio():.1%}")
+    if profile: profiler.save(profile)
+
+
+def start_chunk(stream, parts_folder, class_names):
+
+    # Outputs of the frames from the last checkpoint
+    start = stream["start"]
+    if stream["frames"]: stream["frames"].start(start)
+    if stream["detections_path"]: stream["detection_writer"] = DetectionWriter(f"{parts_folder}/YOLO_{stream['filename']}_{start:08d}.npz", class_names)
+
+
+def commit_chunk(manifest, stream):
+
+    # Wait for the outputs of the frames since the last checkpoint to be on disk, then record them as done
+    outputs = stream["frames"].commit() if stream["frames"] else []
+    if stream["detections_path"]:
+        stream["detection_writer"].close()
+        outputs.append(stream["detection_writer"].path)
+
+    if stream["end"] > stream["start"]:
+        manifest.add(stream["filename"], stream["start"], stream["end"], outputs)
+        stream["start"] = stream["end"]
+
+
+def finish_stream(manifest, stream):
+
+    commit_chunk(manifest, stream)
+
+    # Join the outputs of all the chunks, including the ones of previous runs
+    parts = [path for entry in manifest.get_entries(stream["filename"]) for path in entry["outputs"]]
+    outputs = stream["frames"].close([path for path in parts if path.endswith(".mp4")]) if stream["frames"] else []
+
+    if stream["detections_path"]:
+        detection_writer = DetectionWriter(stream["detections_path"])
+        for path in parts:
+            if path.endswith(".npz"): detection_writer.load(path)
+        detection_writer.close()
+        outputs.append(stream["detections_path"])
+
+    manifest.add(stream["filename"], stream["end"], stream["end"], outputs, complete=True)
+
+
+def detect_segments(inputs, output, out_format, out_fps, max_out_width, do_labels, render, save_detections, detector_kwargs, segments):
 
     os.makedirs(output, exist_ok=True)
 
-    if out_format == "mp4": out = cv.VideoWriter(f"{output}/YOLO_{filename}.mp4", cv.VideoWriter_fourcc(*"mp4v"), out_fps, (width, height))
+    # Each input is split into segments of consecutive frames, each worker process seeks to the start of its segments
+    names = get_stream_names(inputs)
+    jobs = []
+    for k, (input, filename) in enumerate(zip(inputs, names)):
+
+        first_frame = next(frame_iterator(input))
+        height, width = first_frame.shape[:2]
+        frame_width, frame_height = get_output_size(width, height, out_format, max_out_width)
+
+        n_frames = get_total_frames(input)
+        bounds = [n_frames * s // segments for s in range(segments + 1)]
+        for s in range(segments):
+
+            # The last segment goes to the end of the input (the frame count of a video can be approximate)
+            start, end = bounds[s], bounds[s + 1] if s < segments - 1 else None
+            if end is not None and end <= start:
+                continue
 
-    tot_frames = get_total_frames(input)
-    for i, frame in enumerate(tqdm(frame_iterator(input), total=tot_frames, desc="Processing frames", unit="frame", colour="green")):
+            jobs.append({
+                "stream": k,
+                "key": (k, s),
+                "input": input,
+                "start": start,
+                "end": end,
+                "size": (frame_width, frame_height),
+                "scale_factor": min(frame_width, frame_height) / 1000,
+                "do_labels": do_labels,
+                "render": render,
+                "save": bool(save_detections),
+                "fps": out_fps,
+                "video": f"{output}/YOLO_{filename}_part{s}.mp4" if out_format == "mp4" and render else None,
+                "image": f"{output}/YOLO_{filename}_{{}}.{out_format}",
+            })
 
-        annotated_frame = model(frame)
+    n_threads = max(1, (os.cpu_count() or 1) // segments)
+    with ProcessPoolExecutor(max_workers=segments, initializer=init_worker, initargs=(detector_kwargs, n_threads)) as executor:
+        results = list(tqdm(executor.map(detect_segment, jobs), total=len(jobs), desc="Processing segments", unit="segment", colour="green"))
 
-        if out_format == 'mp4':
-            out.write(annotated_frame)
-        else:
-            cv.imwrite(f"{output}/YOLO_{filename}_{i}.{out_format}", annotated_frame)
+    # Merge the outputs of the segments of each input in order
+    for k, filename in enumerate(names):
 
-    
-    if out_format == "mp4": out.release()
+        parts = [(job, result) for job, result in zip(jobs, results) if job["stream"] == k]
 
+        if out_format == "mp4" and render:
+            concat_videos([job["video"] for job, _ in parts], f"{output}/YOLO_{filename}.mp4", out_fps, parts[0][0]["size"])
+            for job, _ in parts:
+                os.remove(job["video"])
 
+        if save_detections:
+            detection_writer = DetectionWriter(stream_path(save_detections, filename, len(inputs) > 1), parts[0][1].class_names)
+            for _, result in parts:
+                detection_writer.extend(result)
+            detection_writer.close()
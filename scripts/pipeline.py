@@ -0,0 +1,135 @@
+import glob
+import os
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+from modules.profiler import profiler
+from modules.utils import prefetch_iterator, get_output_size, AsyncWriter
+from modules.detector import Detector
+from modules.tracker import Tracker
+from scripts.stitch import get_stitcher
+
+
+def run_pipeline(args):
+
+    frame_folder = args.frame_folder
+    output = args.output
+    out_format = args.out_format
+    out_fps = args.out_fps
+    ref_frame = args.ref_frame
+    ref_candidates = args.ref_candidates
+    adjacency = args.adjacency
+    kp_detector = args.kp_detector
+    warper_type = args.warper
+    blend = args.blend
+    calib = args.calib
+    save_stitched = args.save_stitched
+    stitch_format = args.stitch_format
+    tracker = args.tracker
+    detector = args.detector
+    tile_mode = args.tile_mode
+    tile_size = args.tile_size
+    min_ov_ratio = args.min_ov_ratio
+    iou_thresh = args.iou_thresh
+    do_labels = args.do_labels
+    max_out_width = args.max_out_width
+    batch_size = args.batch_size
+    merge_mode = args.merge_mode
+    detect_on = args.detect_on
+    detect_every = args.detect_every
+    adaptive = args.adaptive_detect
+    motion_gate = args.motion_gate
+    backend = args.backend
+    precision = args.precision
+    profile = args.profile
+
+    # Frames are consumed in order by the tracker
+    folders = sorted(os.listdir(frame_folder))
+    frames = [sorted(glob.glob(f'{frame_folder}/{folder}/*.jpg')) for folder in folders]
+    filename = frame_folder.rstrip("/").split("/")[-1]
+
+    stitcher = get_stitcher(frames, ref_frame, kp_detector, warper_type, calib, adjacency, ref_candidates, blend)
+    if not stitcher.ready:
+        return
+
+    os.makedirs(output, exist_ok=True)
+    if save_stitched:
+        os.makedirs(save_stitched, exist_ok=True)
+        stitched_writer = AsyncWriter()
+
+    # Boxes are drawn on the resized output frame, scaled to its size
+    width, height = stitcher.panorama_size
+    frame_width, frame_height = get_output_size(width, height, out_format, max_out_width)
+    scale_factor = min(frame_width, frame_height) / 1000
+
+    if tracker == "none":
+        model = Detector(detector, tile_mode, tile_size, min_ov_ratio, iou_thresh, scale_factor, do_labels, batch_size, merge_mode, motion_gate, backend, precision)
+        prefix = "YOLO"
+    else:
+        model = Tracker(tracker, detector, tile_mode, tile_size, min_ov_ratio, iou_thresh, scale_factor, do_labels, batch_size, merge_mode, detect_every, adaptive, motion_gate, backend, precision)
+        prefix = tracker
+
+    video = cv.VideoWriter(f"{output}/{prefix}_{filename}.mp4", cv.VideoWriter_fourcc(*"mp4v"), out_fps, (frame_width, frame_height)) if out_format == "mp4" else None
+    writer = AsyncWriter(video)
+
+    if profile: profiler.enable()
+
+    # Decode and stitch the next frames in the background while the current one goes through the model
+    # (when profiling, "stitch" is the time spent waiting for the stitched frame, the stitching stages overlap the others)
+    views = prefetch_iterator([cv.imread(p) for p in frame] for frame in frames)
+    stitched = prefetch_iterator((stitch_views(stitcher, frame_views) for frame_views in views), queue_size=2)
+
+    for i, (frame_views, frame, stitch_stages) in enumerate(tqdm(profiler.iterate("stitch", stitched), total=len(frames), desc="Processing frames", unit="frame", colour="green")):
+
+        # The stitching stages are recorded with the frame they stitched
+        profiler.add(stitch_stages)
+
+        # Writing the panoramas to disk is optional
+        if save_stitched:
+            with profiler.stage("write"):
+                stitched_writer.write(frame, f"{save_stitched}/{folders[i]}.{stitch_format}")
+
+        if detect_on == "views" and tracker == "none":
+            detections, labels = detect_views(model, stitcher, frame_views)
+        elif detect_on == "views":
+            detections, labels = model.track(frame, detect=lambda: detect_views(model.detector, stitcher, frame_views))
+        elif tracker == "none":
+            detections, labels = model.detect(frame, .3)
+        else:
+            detections, labels = model.track(frame)
+
+        annotated_frame = model.annotator(frame, detections, labels, (frame_width, frame_height))
+
+        with profiler.stage("write"):
+            if out_format == 'mp4':
+                writer.write(annotated_frame)
+            else:
+                writer.write(annotated_frame, f"{output}/{prefix}_{filename}_{i}.{out_format}")
+
+        profiler.next_frame()
+
+    writer.close()
+    if save_stitched: stitched_writer.close()
+    if motion_gate: print(f"Tiles skipped by the motion gate : {(model if tracker == 'none' else model.detector).skipped_ratio():.1%}")
+    if profile: profiler.save(profile)
+
+
+def stitch_views(stitcher, views):
+
+    # Stitched in a background thread, its stages are kept apart from the frame the main thread is timing
+    with profiler.capture() as stages:
+        frame = stitcher.stitch(views)
+
+    return views, frame, stages
+
+
+def detect_views(detector, stitcher, views, conf_thresh=.3):
+
+    # Run the model on the original views (their tiles share the same batches)
+    raw_detections = detector.infer(views, conf_thresh)
+
+    # Map the boxes of each view to the panorama, duplicates in the overlapping areas are removed when merging
+    projected = [stitcher.project_boxes(idx, np.concatenate(dets)) for idx, dets in enumerate(raw_detections) if dets]
+    detections = detector.merge_detections(projected)
+
+    return detections, detector.get_labels(detections)
@@ -1,38 +1,193 @@
 import glob
 import os
 import argparse
+import multiprocessing
 import cv2 as cv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from modules.stitcher import Stitcher
+from modules.utils import prefetch_iterator, synced_frames, get_synced_length, get_inputs, get_fps, get_total_frames, write_image, AsyncWriter
+from modules.manifest import Manifest
+from modules.profiler import profiler
+
+
+# Stitcher of the current worker process, built once from the fitted state
+_worker_stitcher = None
+
+def init_worker(state, blend):
+
+    global _worker_stitcher
+    # Parallelism comes from the processes, avoid oversubscribing the cores with OpenCV threads
+    cv.setNumThreads(1)
+    _worker_stitcher = Stitcher.from_state(state, blend)
+    _worker_stitcher.view_workers = 1
+
+
+def stitch_frame(frame, out_path=None):
+
+    # The stitched frame is sent back when it is not written by the worker (e.g. to a video)
+    stitched = _worker_stitcher.stitch(frame)
+    if out_path is None:
+        return stitched
+
+    write_image(out_path, stitched)
+    return out_path
+
 
 def run_stitching(args):
 
     frame_folder = args.frame_folder
+    videos = get_inputs(args.videos) if args.videos else None
+    offsets = args.offsets
+    sync = args.sync
     output = args.output
     out_format = args.out_format
+    out_fps = args.out_fps
     ref_frame  = args.ref_frame
+    ref_candidates = args.ref_candidates
+    adjacency = args.adjacency
     detector = args.detector
     warper_type = args.warper
+    blend = args.blend
+    calib = args.calib
+    workers = args.workers
+    resume = args.resume
+    profile = args.profile
 
-    folders = os.listdir(frame_folder)
-    frames = [glob.glob(f'{frame_folder}/{folder}/*.jpg') for folder in folders]
+    if videos and offsets and len(offsets) != len(videos):
+        print("--offsets needs one value per video")
+        return
 
     os.makedirs(output, exist_ok=True)
 
-    if ref_frame:
-        ref_images = glob.glob(f"{ref_frame}/*")
+    # Each frame is recorded once written, a resumed run only stitches the other ones
+    # (a video is only recorded once complete, an interrupted one is stitched again)
+    manifest = Manifest(f"{output}/manifest.jsonl", resume)
+    done = manifest.done("frames")
+    if done: print(f"{len(done)} frames already stitched")
+
+    if videos:
+        # The views are read in lockstep from the videos, without intermediate files
+        n_frames = get_synced_length(videos, offsets, sync)
+        first = min(i for i in range(n_frames + 1) if i not in done)
+        steps = ((i, views) for i, views in enumerate(synced_frames(videos, offsets, sync, first), first) if i not in done)
+        total = n_frames - len(done)
+        out_paths = lambda i: f"{output}/{i:08d}.{out_format}"
+        # Frames on which the stitching parameters are estimated, evenly spaced in the videos
+        frames = [next(synced_frames(videos, offsets, sync, k * n_frames // ref_candidates)) for k in range(min(ref_candidates, n_frames))]
+        out_fps = out_fps or get_fps(videos[0])
     else:
-        ref_images = frames[0]
+        # Sorted so that the frame indices of the manifest are the same from one run to the other
+        folders = sorted(os.listdir(frame_folder))
+        # Views sorted by name, the adjacency of the rig refers to this order
+        frames = [sorted(glob.glob(f'{frame_folder}/{folder}/*.jpg')) for folder in folders]
+        steps = ((i, frame) for i, frame in enumerate(frames) if i not in done)
+        total = len(frames) - len(done)
+        out_paths = lambda i: f"{output}/{folders[i]}.{out_format}"
+        out_fps = out_fps or 30
 
-    # Estimate the stitching parameters on the ref frame and refine parameters with the first frame
-    stitcher = Stitcher(detector, warper_type).fit(ref_images, refining_img_paths=frames[0])
+    if total <= 0:
+        manifest.close()
+        return
+
+    def record(i):
+        manifest.add("frames", i, i + 1, [out_paths(i)])
+
+    stitcher = get_stitcher(frames, ref_frame, detector, warper_type, calib, adjacency, ref_candidates, blend)
 
     # Stitch each frame if the parameters have been estimated
     if stitcher.ready:
 
-        for i, frame in enumerate(tqdm(frames, total=len(frames), desc="Processing frames", unit="frame", colour="green")):
-            stitched_frame = stitcher.stitch(frame)
-            cv.imwrite(f"{output}/{folders[i]}.{out_format}", stitched_frame)
+        if profile: profiler.enable()
+
+        # Encode the stitched frames in the background, in order in a video
+        video_path = f"{output}/stitched.mp4" if out_format == "mp4" else None
+        writer = AsyncWriter(cv.VideoWriter(video_path, cv.VideoWriter_fourcc(*"mp4v"), out_fps, stitcher.panorama_size) if video_path else None)
+        if video_path and resume: print("Warning: an interrupted video is stitched again from the first frame")
+
+        def write(i, stitched_frame):
+            if video_path:
+                writer.write(stitched_frame)
+            else:
+                writer.write(stitched_frame, out_paths(i), callback=lambda: record(i))
+
+        if workers > 1:
+            if profile: print("Warning: the stitching stages are only profiled with a single worker")
+            # Images are written by the workers, the frames of a video are sent back
+            if video_path:
+                stitch_parallel(stitcher, steps, lambda i: None, workers, total, callback=write)
+            else:
+                stitch_parallel(stitcher, steps, out_paths, workers, total, callback=lambda i, _: record(i))
+        else:
+            for i, stitched_frame in tqdm(stitch_frames(stitcher, steps), total=total, desc="Processing frames", unit="frame", colour="green"):
+                with profiler.stage("write"):
+                    write(i, stitched_frame)
+                profiler.next_frame()
+
+        writer.close()
+        if video_path: manifest.add("frames", 0, get_total_frames(video_path), [video_path])
+
+        if profile: profiler.save(profile)
 
         print("Frames stitched successfully")
 
+    manifest.close()
+
+
+def get_stitcher(frames, ref_frame=None, detector="orb", warper_type="spherical", calib=None, adjacency="all", ref_candidates=1, blend="multiband"):
+
+    if calib and os.path.isfile(calib):
+        # Reuse the stitching parameters estimated on a previous run
+        return Stitcher.load(calib, blend)
+
+    # Several reference frames can be given, or taken evenly spaced in the input, the cameras are estimated on the one matching best
+    if ref_frame:
+        ref_images = [sorted(glob.glob(f"{folder}/*")) for folder in ref_frame]
+    else:
+        ref_images = [frames[k * len(frames) // ref_candidates] for k in range(min(ref_candidates, len(frames)))]
+
+    # Estimate the stitching parameters on the ref frame and refine parameters with the first frame
+    stitcher = Stitcher(detector, warper_type, adjacency, blend).fit(ref_images, refining_img_paths=frames[0])
+    if calib and stitcher.ready: stitcher.save(calib)
+
+    return stitcher
+
+
+def stitch_frames(stitcher, steps):
+
+    # Decode the views of the next frames in the background (the frames of videos are already decoded)
+    views = prefetch_iterator((i, [cv.imread(p) if isinstance(p, str) else p for p in frame]) for i, frame in steps)
+    for i, frame in profiler.iterate("read", views):
+        yield i, stitcher.stitch(frame)
+
+
+def stitch_parallel(stitcher, steps, out_paths, workers, total=None, max_in_flight=None, callback=None):
+
+    # Bound the number of pending frames to keep memory usage under control
+    max_in_flight = max_in_flight or 2 * workers
+
+    # The fitted state is sent once to each worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"), initializer=init_worker, initargs=(stitcher.get_state(), stitcher.blend)) as executor:
+
+        pending = deque()
+        with tqdm(total=total, desc="Processing frames", unit="frame", colour="green") as pbar:
+            for i, frame in steps:
+
+                if len(pending) >= max_in_flight:
+                    wait_frame(pending, callback)
+                    pbar.update(1)
+
+                pending.append((i, executor.submit(stitch_frame, frame, out_paths(i))))
+
+            while pending:
+                wait_frame(pending, callback)
+                pbar.update(1)
+
+
+def wait_frame(pending, callback=None):
+
+    # callback is given the index of the frame and the result of the worker (the written path or the stitched frame), in order
+    i, future = pending.popleft()
+    result = future.result()
+    if callback: callback(i, result)
@@ -1,13 +1,17 @@
 from tqdm import tqdm
 import os
-import cv2 as cv
-from modules.utils import frame_iterator, get_total_frames
+import shutil
+from modules.profiler import profiler
+from modules.utils import frame_iterator, prefetch_frames, get_total_frames, get_inputs, get_stream_names, stream_path, interleave, get_output_size
+from modules.detector import Detector
 from modules.tracker import Tracker
+from modules.exporter import DetectionReader, MOTWriter
+from modules.manifest import Manifest, ChunkWriter
 
 
 def run_tracking(args):
 
-    input = args.input
+    inputs = get_inputs(args.input)
     output = args.output
     out_format = args.out_format
     out_fps = args.out_fps
@@ -18,40 +22,152 @@ def run_tracking(args):
     min_ov_ratio = args.min_ov_ratio
     iou_thresh = args.iou_thresh
     do_labels = args.do_labels
+    max_out_width = args.max_out_width
+    render = not args.no_render
+    batch_size = args.batch_size
+    merge_mode = args.merge_mode
+    detect_every = args.detect_every
+    adaptive = args.adaptive_detect
+    motion_gate = args.motion_gate
+    backend = args.backend
+    precision = args.precision
+    profile = args.profile
+    detections_path = args.detections
+    export_mot = args.export_mot
+    resume = args.resume
+    checkpoint_every = args.checkpoint_every
 
+    if not render and not export_mot:
+        print("Nothing to save: use --export_mot with --no_render")
+        return
 
-    if os.path.isdir(input):
-        filename = input.split("/")[-1]
-    else:
-        filename = input.split("/")[-1].split(".")[0]
+    multi = len(inputs) > 1
 
-    first_frame = next(frame_iterator(input))
-    height, width = first_frame.shape[:2]
-    scale_factor = min(width, height) / 1000
-
-    # Resize frames for video output
-    if out_format == "mp4":
-        frame_width = 1920
-        frame_height = int(height / width * frame_width)
-    else:
-        frame_width, frame_height = width, height
-    
-    model = Tracker(tracker, detector, tile_mode, tile_size, min_ov_ratio, iou_thresh, scale_factor, do_labels)
+    # A single model serves all the streams, each stream has its own tracker
+    # No model is needed when the detections of a previous detection run are reused
+    model = Detector(detector, tile_mode, tile_size, min_ov_ratio, iou_thresh, batch_size=batch_size, merge_mode=merge_mode, motion_gate=motion_gate, backend=backend, precision=precision) if not detections_path else None
 
     os.makedirs(output, exist_ok=True)
 
-    if out_format == "mp4": out = cv.VideoWriter(f"{output}/{tracker}_{filename}.mp4", cv.VideoWriter_fourcc(*"mp4v"), out_fps, (frame_width, frame_height))
+    # The outputs and the state of the trackers are committed every checkpoint_every frames,
+    # a resumed run goes on after the last committed chunk of each stream with the same track ids
+    manifest = Manifest(f"{output}/manifest.jsonl", resume)
+    parts_folder = f"{output}/parts"
+    if not resume: shutil.rmtree(parts_folder, ignore_errors=True)
+    os.makedirs(parts_folder, exist_ok=True)
+
+    names = get_stream_names(inputs)
+    streams = []
+    for input, filename in zip(inputs, names):
+
+        last = manifest.last(filename)
+        if last and last.get("complete"):
+            print(f"{filename} : already done")
+            continue
+
+        first_frame = next(frame_iterator(input))
+        height, width = first_frame.shape[:2]
+
+        # Boxes are drawn on the resized output frame, scaled to its size
+        frame_width, frame_height = get_output_size(width, height, out_format, max_out_width)
+        scale_factor = min(frame_width, frame_height) / 1000
+
+        stream = {
+            "input": input,
+            "filename": filename,
+            "start": last["end"] if last else 0,
+            "end": last["end"] if last else 0,
+            "size": (frame_width, frame_height),
+            "tracker": Tracker(tracker, None, scale_factor=scale_factor, do_labels=do_labels, detect_every=detect_every, adaptive=adaptive),
+            "cached_detections": DetectionReader(stream_path(detections_path, filename, multi)) if detections_path else None,
+            "frames": ChunkWriter(output, parts_folder, f"{tracker}_{filename}", out_format, out_fps, (frame_width, frame_height)) if render else None,
+            "mot_writer": MOTWriter(stream_path(export_mot, filename, multi), last.get("mot_offset") if last else None) if export_mot else None,
+            "checkpoint": last.get("checkpoint") if last else None,
+        }
+        if stream["checkpoint"]: stream["tracker"].load_state(stream["checkpoint"])
+        if render: stream["frames"].start(stream["start"])
+        streams.append(stream)
+
+    if profile: profiler.enable()
+
+    # One frame of each stream per step, from the first frame not done yet
+    starts = [stream["start"] for stream in streams]
+    frames = interleave([prefetch_frames(stream["input"], start=start) for stream, start in zip(streams, starts)], starts)
+    tot_frames = sum(get_total_frames(stream["input"]) - start for stream, start in zip(streams, starts))
+    with tqdm(total=tot_frames, desc="Processing frames", unit="frame", colour="green") as progress:
+        for step in profiler.iterate("read", frames):
+
+            # The detection only runs on the keyframes of each stream, their tiles share the inference batches
+            keyframes = [streams[k]["tracker"].is_keyframe(frame) for k, frame, _ in step]
+            to_detect = [(k, frame) for (k, frame, _), keyframe in zip(step, keyframes) if keyframe and model]
+            detected = dict(zip([k for k, _ in to_detect], model.detect_batch([frame for _, frame in to_detect], conf_thresh=.3, streams=[k for k, _ in to_detect]))) if to_detect else {}
+
+            for (k, frame, i), keyframe in zip(step, keyframes):
+
+                stream = streams[k]
+                cached = stream["cached_detections"]
+                detections = cached[i] if cached is not None else detected.get(k, (None, None))[0]
+
+                detections, labels = stream["tracker"].track(frame, detections, keyframe=keyframe)
+                if export_mot: stream["mot_writer"].add(i, detections)
+
+                # Only the tracks are exported without rendering
+                if render:
+                    annotated_frame = stream["tracker"].annotator(frame, detections, labels, stream["size"])
+
+                    with profiler.stage("write"):
+                        stream["frames"].write(annotated_frame, i)
+
+                stream["end"] = i + 1
+                if checkpoint_every and stream["end"] - stream["start"] >= checkpoint_every:
+                    with profiler.stage("write"):
+                        commit_chunk(manifest, stream, parts_folder)
+                        if render: stream["frames"].start(stream["start"])
+
+                progress.update()
+
+            profiler.next_frame()
+
+    for stream in streams:
+        finish_stream(manifest, stream, parts_folder)
+    manifest.close()
+    shutil.rmtree(parts_folder, ignore_errors=True)
+
+    if motion_gate and model: print(f"Tiles skipped by the motion gate : {model.skipped_ratio():.1%}")
+    if profile: profiler.save(profile)
+
+
+def commit_chunk(manifest, stream, parts_folder):
+
+    # Wait for the outputs of the frames since the last checkpoint to be on disk, then record them as done with the state of the tracker
+    outputs = stream["frames"].commit() if stream["frames"] else []
+    if stream["end"] == stream["start"]:
+        return
+
+    info = {}
+    if stream["mot_writer"]: info["mot_offset"] = stream["mot_writer"].flush()
+
+    previous = stream["checkpoint"]
+    stream["checkpoint"] = f"{parts_folder}/{stream['filename']}_tracker_{stream['end']:08d}.pkl"
+    stream["tracker"].save_state(stream["checkpoint"])
+
+    manifest.add(stream["filename"], stream["start"], stream["end"], outputs, checkpoint=stream["checkpoint"], **info)
+    stream["start"] = stream["end"]
+
+    # The previous checkpoint is only removed once the new one is recorded
+    if previous: os.remove(previous)
+
 
-    tot_frames = get_total_frames(input)
-    for i, frame in enumerate(tqdm(frame_iterator(input), total=tot_frames, desc="Processing frames", unit="frame", colour="green")):
+def finish_stream(manifest, stream, parts_folder):
 
-        annotated_frame = model(frame)
+    commit_chunk(manifest, stream, parts_folder)
 
-        if out_format == 'mp4':
-            out.write(cv.resize(annotated_frame, (frame_width, frame_height)))
-        else:
-            cv.imwrite(f"{output}/{tracker}_{filename}_{i}.{out_format}", annotated_frame)
+    # Join the video parts of all the chunks, including the ones of previous runs
+    parts = [path for entry in manifest.get_entries(stream["filename"]) for path in entry["outputs"]]
+    outputs = stream["frames"].close([path for path in parts if path.endswith(".mp4")]) if stream["frames"] else []
 
-    
-    if out_format == "mp4": out.release()
+    if stream["mot_writer"]:
+        stream["mot_writer"].close()
+        outputs.append(stream["mot_writer"].file.name)
 
+    manifest.add(stream["filename"], stream["end"], stream["end"], outputs, complete=True)